@@ -0,0 +1,68 @@
+# loading an area of interest (AOI) from a GeoJSON or any other vector file, shared by resampling.py and mosaic_tifs.py
+
+import json
+import os
+
+try:
+    import geopandas
+except ImportError:
+    # Without geopandas only GeoJSON files can be read
+    geopandas = None
+
+
+# Geometries of a GeoJSON object, which may be a FeatureCollection, a Feature or a bare geometry
+def geojson_geometries(data):
+    if data["type"] == "FeatureCollection":
+        return [feature["geometry"] for feature in data["features"] if feature.get("geometry")]
+    if data["type"] == "Feature":
+        return [data["geometry"]] if data.get("geometry") else []
+    return [data]
+
+
+# The AOI as {"crs": CRS string, "geometries": [GeoJSON geometry dicts]}; each script transforms it with its own stack
+def load_aoi(aoi_path):
+    if os.path.splitext(aoi_path)[1].lower() in (".geojson", ".json"):
+        with open(aoi_path) as f:
+            data = json.load(f)
+        # GeoJSON is WGS84 unless a (pre-RFC 7946) crs member says otherwise
+        crs = data.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+        geometries = geojson_geometries(data)
+    else:
+        if geopandas is None:
+            raise ImportError(f"Reading {aoi_path} requires geopandas; convert the AOI to GeoJSON otherwise.")
+        frame = geopandas.read_file(aoi_path)
+        crs = frame.crs.to_string() if frame.crs else "EPSG:4326"
+        geometries = [geometry.__geo_interface__ for geometry in frame.geometry if geometry is not None]
+    if not geometries:
+        raise ValueError(f"The AOI {aoi_path} contains no geometries.")
+    return {"crs": crs, "geometries": geometries}
+
+
+def iter_coordinates(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+        return
+    for part in coordinates:
+        yield from iter_coordinates(part)
+
+
+# Bounds (minx, miny, maxx, maxy) of GeoJSON geometries
+def geometry_bounds(geometries):
+    xs = []
+    ys = []
+    for geometry in geometries:
+        parts = geometry["geometries"] if geometry["type"] == "GeometryCollection" else [geometry]
+        for part in parts:
+            for x, y, *_ in iter_coordinates(part["coordinates"]):
+                xs.append(x)
+                ys.append(y)
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+# Intersection of two bounds, or None when they do not overlap
+def intersect_bounds(bounds, other):
+    minx, miny = max(bounds[0], other[0]), max(bounds[1], other[1])
+    maxx, maxy = min(bounds[2], other[2]), min(bounds[3], other[3])
+    if minx >= maxx or miny >= maxy:
+        return None
+    return (minx, miny, maxx, maxy)
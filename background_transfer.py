@@ -0,0 +1,111 @@
+# moving finished outputs from the fast temporary storage to their final folder in a background thread
+
+import os
+import queue
+import shutil
+import hashlib
+import time
+from threading import Thread, Condition
+from instrumentation import gauge, span
+
+
+def file_checksum(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Copy a file next to its destination, verify it and only then rename it into place and delete the source
+def transfer_file(source_path, final_folder, verify="size"):
+    final_path = os.path.join(final_folder, os.path.basename(source_path))
+    if os.stat(source_path).st_dev == os.stat(final_folder).st_dev:
+        # Same file system, a rename is atomic and needs no verification
+        os.replace(source_path, final_path)
+        return final_path
+
+    part_path = f"{final_path}.part"
+    shutil.copyfile(source_path, part_path)
+    if verify == "checksum":
+        verified = file_checksum(source_path) == file_checksum(part_path)
+    else:
+        verified = os.path.getsize(source_path) == os.path.getsize(part_path)
+    if not verified:
+        os.remove(part_path)
+        raise IOError(f"Verification ({verify}) of {final_path} failed.")
+    os.replace(part_path, final_path)
+    os.remove(source_path)
+    return final_path
+
+
+def transfer_worker(state, final_folder, verify):
+    while True:
+        item = state["queue"].get()
+        if item is None:
+            break
+        source_path, size, on_done = item
+        try:
+            with span("transfer", file=os.path.basename(source_path)) as record:
+                final_path = transfer_file(source_path, final_folder, verify)
+                record["bytes"] = size
+            if on_done:
+                on_done(final_path)
+            state["transferred_files"] += 1
+            state["transferred_bytes"] += size
+        except Exception as e:
+            # The source stays in the temporary folder and is picked up by the final sweep
+            print(f"Übertragung von {source_path} fehlgeschlagen: {e}")
+            state["failed"].append(source_path)
+        finally:
+            with state["condition"]:
+                state["pending_bytes"] -= size
+                state["condition"].notify_all()
+
+
+def start_transfer_worker(final_folder, verify="size"):
+    state = {
+        "queue": queue.Queue(),
+        "condition": Condition(),
+        "pending_bytes": 0,
+        "transferred_files": 0,
+        "transferred_bytes": 0,
+        "failed": [],
+        "start_time": time.time(),
+    }
+    state["thread"] = Thread(target=transfer_worker, args=(state, final_folder, verify), daemon=False)
+    state["thread"].start()
+    return state
+
+
+# on_done is called with the final path once the file has been moved
+def enqueue_transfer(state, source_path, on_done=None):
+    size = os.path.getsize(source_path)
+    with state["condition"]:
+        state["pending_bytes"] += size
+        gauge("transfer_pending_bytes", state["pending_bytes"])
+    state["queue"].put((source_path, size, on_done))
+
+
+# Block while the outputs still waiting in the temporary folder exceed the byte budget
+def wait_for_transfer_budget(state, max_pending_bytes):
+    with state["condition"]:
+        if state["pending_bytes"] < max_pending_bytes:
+            return
+        pending_mb = state["pending_bytes"] / (1024 * 1024)
+        print(f"Temporärer Ordner enthält {pending_mb:.0f} MB, warte auf Übertragungen...")
+        while state["pending_bytes"] >= max_pending_bytes:
+            state["condition"].wait()
+
+
+# Let the worker finish every queued transfer, then stop it
+def stop_transfer_worker(state):
+    state["queue"].put(None)
+    state["thread"].join()
+    elapsed_time = time.time() - state["start_time"]
+    print(
+        f"{state['transferred_files']} Dateien ({state['transferred_bytes'] / (1024 * 1024):.1f} MB) im Hintergrund "
+        f"in {elapsed_time:.2f} Sekunden übertragen."
+    )
+    if state["failed"]:
+        print(f"{len(state['failed'])} Übertragungen fehlgeschlagen: {', '.join(state['failed'])}")
@@ -0,0 +1,428 @@
+# benchmarking the performance paths of the preprocessing scripts against their GDAL baselines, and the scripts end to
+# end on synthetic Sentinel-2 SAFE folders and mosaic inputs
+
+import os
+import argparse
+import json
+import shutil
+import time
+from threading import Thread, Event
+import numpy as np
+import psutil
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.warp import Resampling, calculate_default_transform, reproject
+
+from rename import rename_files_in_directory
+from resampling import plan_block_windows, plan_fast_path, process_all_folders, resample_block, resample_block_fast
+
+# Bands of the synthetic L2A products per resolution folder, as in real products
+SAFE_BANDS = {
+    10: ["B02", "B03", "B04", "B08"],
+    20: ["B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B11", "B12", "SCL"],
+    60: ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B09", "B11", "B12", "SCL"],
+}
+# Named settings of the performance modes measured end to end; "baseline" runs the code path the scripts had before
+# the performance options: the stacked resampling output and the copy mosaic engine
+RESAMPLING_MODES = {
+    "baseline": {},
+    "direct_write": {"direct_write": True},
+    "scene_workers": {"direct_write": True, "scene_workers": 2},
+    "use_overviews": {"direct_write": True, "use_overviews": True},
+    "cog": {"direct_write": True, "output_profile": "cog-zstd"},
+    "scl_mask": {"direct_write": True, "scl_classes": [0, 1, 3, 8, 9, 10]},
+}
+MOSAIC_MODES = {
+    "baseline": {"engine": "copy"},
+    "vrt": {},
+    "date_workers": {"date_workers": 2},
+    "median": {"composite": "median"},
+    "cog": {"output_profile": "cog-zstd"},
+}
+
+
+# Time the NumPy integer-factor fast path against GDAL's warp on the same synthetic band
+def benchmark_fast_path(size, src_res, dst_res, method, block_size=512, repeats=3):
+    rng = np.random.default_rng(0)
+    data = rng.integers(1, 10000, (size, size), dtype=np.uint16)
+    resampling = Resampling[method]
+    dst_size = size * src_res // dst_res
+
+    with MemoryFile() as memfile, memfile.open(
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=1,
+        dtype="uint16",
+        crs="EPSG:32633",
+        transform=from_origin(300000, 5800020, src_res, src_res),
+        nodata=0,
+    ) as src:
+        src.write(data, 1)
+        dst_transform = from_origin(300000, 5800020, dst_res, dst_res)
+        windows = plan_block_windows(dst_size, dst_size, block_size)
+        plan = plan_fast_path(src, dst_transform, src.crs, resampling)
+        if plan is None:
+            raise ValueError(f"{src_res} m -> {dst_res} m is not an integer-factor resampling.")
+
+        def run_fast():
+            return [resample_block_fast(src, window, plan, np.dtype("uint16"), resampling) for window in windows]
+
+        def run_warp():
+            return [
+                resample_block(src, window, dst_transform, src.crs, np.dtype("uint16"), resampling)
+                for window in windows
+            ]
+
+        timings = {}
+        results = {}
+        for name, run in (("fast", run_fast), ("warp", run_warp)):
+            best = float("inf")
+            for _ in range(repeats):
+                start = time.perf_counter()
+                results[name] = run()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+
+        max_difference = max(
+            int(np.abs(fast.astype(np.int64) - warp.astype(np.int64)).max())
+            for fast, warp in zip(results["fast"], results["warp"])
+        )
+
+    return {
+        "source_resolution": src_res,
+        "target_resolution": dst_res,
+        "method": method,
+        "source_size": size,
+        "fast_seconds": timings["fast"],
+        "warp_seconds": timings["warp"],
+        "speedup": timings["warp"] / timings["fast"],
+        "max_difference": max_difference,
+    }
+
+
+# Synthetic L2A SAFE folders with JP2 bands in R10m, R20m and R60m; scene_size is the edge length at 10 m
+def generate_safe_folders(base_folder, scenes=4, scene_size=1098, seed=0):
+    rng = np.random.default_rng(seed)
+    for scene in range(scenes):
+        date = f"202306{scene + 1:02d}"
+        name = f"S2A_MSIL2A_{date}T101031_N0509_R022_T33UUU_{date}T150000.SAFE"
+        granule = os.path.join(base_folder, name, "GRANULE", f"L2A_T33UUU_A{scene:06d}_{date}T101031", "IMG_DATA")
+        for resolution, bands in SAFE_BANDS.items():
+            size = scene_size * 10 // resolution
+            folder = os.path.join(granule, f"R{resolution}m")
+            os.makedirs(folder, exist_ok=True)
+            for band in bands:
+                if band == "SCL":
+                    data = rng.integers(0, 12, (size, size), dtype=np.uint8)
+                else:
+                    data = rng.integers(1, 10000, (size, size), dtype=np.uint16)
+                with rasterio.open(
+                    os.path.join(folder, f"T33UUU_{date}T101031_{band}_{resolution}m.jp2"),
+                    "w",
+                    driver="JP2OpenJPEG",
+                    width=size,
+                    height=size,
+                    count=1,
+                    dtype=data.dtype,
+                    crs="EPSG:32633",
+                    transform=from_origin(300000, 5800020, resolution, resolution),
+                    QUALITY=100,
+                    REVERSIBLE="YES",
+                    RESOLUTIONS=4,
+                ) as dst:
+                    dst.write(data, 1)
+
+
+# Overlapping multiband GeoTIFFs named like the outputs of resampling.py; every second tile is reprojected into
+# the neighbouring UTM zone, so the mosaic has to transform mixed CRSs
+def generate_mosaic_inputs(folder, dates=2, tiles_per_date=3, tile_size=1098, bands=10, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    for date_index in range(dates):
+        date = f"202306{date_index + 1:02d}"
+        for tile in range(tiles_per_date):
+            # Neighbouring tiles overlap by a quarter of their width
+            transform = from_origin(300000 + tile * tile_size * 7.5, 5800020, 10, 10)
+            data = rng.integers(1, 10000, (bands, tile_size, tile_size), dtype=np.uint16)
+            crs = "EPSG:32633"
+            if tile % 2:
+                left, top = transform * (0, 0)
+                right, bottom = transform * (tile_size, tile_size)
+                dst_transform, width, height = calculate_default_transform(
+                    crs, "EPSG:32632", tile_size, tile_size, left, bottom, right, top, resolution=10
+                )
+                reprojected = np.zeros((bands, height, width), dtype=np.uint16)
+                reproject(data, reprojected, src_transform=transform, src_crs=crs, dst_transform=dst_transform,
+                          dst_crs="EPSG:32632", src_nodata=0, dst_nodata=0)
+                data, transform, crs = reprojected, dst_transform, "EPSG:32632"
+            name = f"{date}_S2A_MSIL2A_{date}T101031_N0509_R022_T33UUU_{date}T15000{tile}.SAFE.tif"
+            with rasterio.open(
+                os.path.join(folder, name),
+                "w",
+                driver="GTiff",
+                width=data.shape[2],
+                height=data.shape[1],
+                count=bands,
+                dtype="uint16",
+                crs=crs,
+                transform=transform,
+                nodata=0,
+                tiled=True,
+            ) as dst:
+                dst.write(data)
+
+
+# Empty files with the names of downloaded Sentinel-1 and Sentinel-2 products, as rename.py expects them; the index
+# in the absolute orbit or the tile keeps every name unique
+def generate_rename_inputs(folder, count=1000):
+    os.makedirs(folder, exist_ok=True)
+    for index in range(count):
+        date = f"2023{index % 12 + 1:02d}{index % 28 + 1:02d}"
+        if index % 2:
+            name = f"S2A_MSIL2A_{date}T101031_N0509_R022_T{index:05d}_{date}T150000.SAFE_B{index % 12 + 1:02d}.tif"
+        else:
+            name = f"S1A_IW_GRDH_1SDV_{date}T051234_{date}T051259_{index:06d}_ABCDEF_1234_Cal_Spk_dB_TC.tif"
+        open(os.path.join(folder, name), "w").close()
+
+
+def folder_bytes(folders):
+    total = 0
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    # Removed while walking
+                    continue
+    return total
+
+
+# Sample the RSS of this process and its workers and the size of the temporary folders while a run is measured
+def sample_run(stop_event, stats, temp_folders, interval=0.2):
+    process = psutil.Process(os.getpid())
+    while not stop_event.is_set():
+        rss = 0
+        for member in [process] + process.children(recursive=True):
+            try:
+                rss += member.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+        stats["peak_rss"] = max(stats["peak_rss"], rss)
+        temp_bytes = folder_bytes(temp_folders) - stats["initial_temp_bytes"]
+        stats["peak_temp_bytes"] = max(stats["peak_temp_bytes"], temp_bytes)
+        stop_event.wait(interval)
+
+
+# Wall time, throughput, peak RSS (including worker processes) and peak temporary disk usage of one run
+def measure_run(run, input_bytes, temp_folders=()):
+    stats = {"peak_rss": 0, "peak_temp_bytes": 0, "initial_temp_bytes": folder_bytes(temp_folders)}
+    stop_event = Event()
+    sampler = Thread(target=sample_run, args=(stop_event, stats, temp_folders), daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        run()
+    finally:
+        seconds = time.perf_counter() - start
+        stop_event.set()
+        sampler.join()
+    return {
+        "seconds": seconds,
+        "input_mb": input_bytes / (1024 * 1024),
+        "mb_per_second": input_bytes / (1024 * 1024) / seconds,
+        "peak_rss_mb": stats["peak_rss"] / (1024 * 1024),
+        "peak_temp_mb": stats["peak_temp_bytes"] / (1024 * 1024),
+    }
+
+
+def benchmark_resampling(source_folder, work_folder, mode, resolution=10, max_workers=4):
+    # process_all_folders deletes finished scenes from the base folder, so every run gets a fresh copy
+    base_folder = os.path.join(work_folder, "safe")
+    temp_folder = os.path.join(work_folder, "temp")
+    final_folder = os.path.join(work_folder, "final")
+    shutil.copytree(source_folder, base_folder)
+    os.makedirs(temp_folder)
+    os.makedirs(final_folder)
+    bands = ["B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B11", "B12"]
+    result = measure_run(
+        lambda: process_all_folders(
+            base_folder,
+            temp_folder,
+            final_folder,
+            bands,
+            resolution,
+            max_workers,
+            max_temp_mb=20480,
+            **RESAMPLING_MODES[mode],
+        ),
+        folder_bytes([source_folder]),
+        [base_folder, temp_folder],
+    )
+    result["output_mb"] = folder_bytes([final_folder]) / (1024 * 1024)
+    return result
+
+
+def benchmark_mosaic(input_folder, work_folder, mode):
+    # The GDAL Python bindings are only needed for this benchmark
+    from mosaic_tifs import combine_tifs, list_extension
+
+    temp_folder = os.path.join(work_folder, "temp")
+    output_folder = os.path.join(work_folder, "mosaics")
+    os.makedirs(temp_folder)
+    os.makedirs(output_folder)
+    result = measure_run(
+        lambda: combine_tifs(list_extension(input_folder, "tif"), temp_folder, output_folder, **MOSAIC_MODES[mode]),
+        folder_bytes([input_folder]),
+        [temp_folder],
+    )
+    result["output_mb"] = folder_bytes([output_folder]) / (1024 * 1024)
+    return result
+
+
+def benchmark_rename(source_folder, work_folder):
+    directory = os.path.join(work_folder, "rename")
+    shutil.copytree(source_folder, directory)
+    result = measure_run(lambda: rename_files_in_directory(directory), 0)
+    result["files"] = len(os.listdir(directory))
+    result["files_per_second"] = result["files"] / result["seconds"]
+    return result
+
+
+# Generate the synthetic data once, then run every selected mode of every script on a fresh copy of it
+def benchmark_end_to_end(work_folder, scenes, scene_size, dates, tiles_per_date, rename_files, resampling_modes,
+                         mosaic_modes, max_workers):
+    data_folder = os.path.join(work_folder, "data")
+    safe_folder = os.path.join(data_folder, "safe")
+    mosaic_folder = os.path.join(data_folder, "mosaic_inputs")
+    rename_folder = os.path.join(data_folder, "rename")
+    if not os.path.exists(safe_folder):
+        print(f"Generating {scenes} SAFE folders of {scene_size} x {scene_size} pixels...")
+        generate_safe_folders(safe_folder, scenes, scene_size)
+    if not os.path.exists(mosaic_folder):
+        print(f"Generating {dates * tiles_per_date} mosaic inputs...")
+        generate_mosaic_inputs(mosaic_folder, dates, tiles_per_date, scene_size)
+    if not os.path.exists(rename_folder):
+        generate_rename_inputs(rename_folder, rename_files)
+
+    results = []
+    runs = [("resampling", mode) for mode in resampling_modes] + [("mosaic", mode) for mode in mosaic_modes]
+    runs.append(("rename", "baseline"))
+    for script, mode in runs:
+        run_folder = os.path.join(work_folder, "runs", f"{script}_{mode}")
+        shutil.rmtree(run_folder, ignore_errors=True)
+        os.makedirs(run_folder)
+        try:
+            if script == "resampling":
+                result = benchmark_resampling(safe_folder, run_folder, mode, max_workers=max_workers)
+            elif script == "mosaic":
+                result = benchmark_mosaic(mosaic_folder, run_folder, mode)
+            else:
+                result = benchmark_rename(rename_folder, run_folder)
+        except ImportError as e:
+            print(f"Skipping {script} {mode}: {e}")
+            continue
+        finally:
+            shutil.rmtree(run_folder, ignore_errors=True)
+        result.update({"script": script, "mode": mode})
+        results.append(result)
+        print(
+            f"{script} {mode}: {result['seconds']:.2f} s, {result['mb_per_second']:.1f} MB/s, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB, peak temp {result['peak_temp_mb']:.1f} MB"
+        )
+    return results
+
+
+# Compare the runs with a previous results file; ratios above 1 are slower than the baseline
+def compare_with_baseline(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(entry["script"], entry["mode"]): entry for entry in json.load(f)["results"]}
+    for result in results:
+        previous = baseline.get((result["script"], result["mode"]))
+        if previous is None:
+            continue
+        print(
+            f"{result['script']} {result['mode']}: {result['seconds'] / previous['seconds']:.2f}x time, "
+            f"{result['peak_rss_mb'] / max(previous['peak_rss_mb'], 1e-9):.2f}x peak RSS of the baseline"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the performance paths of the preprocessing scripts.")
+    parser.add_argument(
+        "--suite",
+        type=str,
+        default="fast_path",
+        choices=["fast_path", "end_to_end"],
+        help="fast_path: NumPy resampling against GDAL's warp; end_to_end: resampling.py, mosaic_tifs.py and "
+        "rename.py on synthetic data",
+    )
+    parser.add_argument("--size", type=int, default=5490, help="Edge length of the synthetic source band in pixels")
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        nargs="+",
+        default=["20:10", "10:20", "60:20"],
+        help="Source:target resolution pairs in metres",
+    )
+    parser.add_argument("--methods", type=str, nargs="+", default=["nearest", "average"], help="Resampling methods")
+    parser.add_argument("--block_size", type=int, default=512, help="Block edge length in pixels")
+    parser.add_argument("--repeats", type=int, default=3, help="Repetitions per measurement, the best one is kept")
+    parser.add_argument("--output", type=str, help="Optional JSON file for the results")
+    parser.add_argument(
+        "--work_folder", type=str, default="benchmark_data", help="Folder for the synthetic data and runs"
+    )
+    parser.add_argument("--scenes", type=int, default=4, help="Number of synthetic SAFE folders")
+    parser.add_argument("--scene_size", type=int, default=1098, help="Edge length of the synthetic scenes at 10 m")
+    parser.add_argument("--dates", type=int, default=2, help="Number of dates of the synthetic mosaic inputs")
+    parser.add_argument("--tiles_per_date", type=int, default=3, help="Overlapping mosaic inputs per date")
+    parser.add_argument("--rename_files", type=int, default=1000, help="Number of files for the rename benchmark")
+    parser.add_argument("--max_workers", type=int, default=4, help="Band workers of resampling.py")
+    parser.add_argument(
+        "--resampling_modes", type=str, nargs="*", default=list(RESAMPLING_MODES), choices=list(RESAMPLING_MODES)
+    )
+    parser.add_argument("--mosaic_modes", type=str, nargs="*", default=list(MOSAIC_MODES), choices=list(MOSAIC_MODES))
+    parser.add_argument("--baseline", type=str, help="Results file of an earlier end-to-end run to compare with")
+    args = parser.parse_args()
+
+    if args.suite == "end_to_end":
+        results = benchmark_end_to_end(
+            args.work_folder,
+            args.scenes,
+            args.scene_size,
+            args.dates,
+            args.tiles_per_date,
+            args.rename_files,
+            args.resampling_modes,
+            args.mosaic_modes,
+            args.max_workers,
+        )
+        if args.baseline:
+            compare_with_baseline(results, args.baseline)
+        if args.output:
+            config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+            with open(args.output, "w") as f:
+                json.dump({"config": config, "results": results}, f, indent=2)
+        return
+
+    results = []
+    for pair in args.pairs:
+        src_res, dst_res = (int(value) for value in pair.split(":"))
+        for method in args.methods:
+            result = benchmark_fast_path(args.size, src_res, dst_res, method, args.block_size, args.repeats)
+            results.append(result)
+            print(
+                f"{src_res} m -> {dst_res} m {method:8s} fast: {result['fast_seconds']:.3f} s  "
+                f"warp: {result['warp_seconds']:.3f} s  speedup: {result['speedup']:.1f}x  "
+                f"max difference: {result['max_difference']}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
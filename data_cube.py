@@ -0,0 +1,153 @@
+# appending resampled scenes or date mosaics to a chunked Zarr data cube with the dimensions time, band, y and x,
+# shared by resampling.py and mosaic_tifs.py; pixel time series are then read from a few chunks instead of one
+# file per date
+
+import os
+import fcntl
+import math
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+try:
+    import zarr
+except ImportError:
+    # The cube sink is optional, everything else works without zarr
+    zarr = None
+
+CUBE_COMPRESSIONS = ["zstd", "lz4", "none"]
+EPOCH = datetime(1970, 1, 1)
+
+
+def cube_settings(cube_path, bounds, chunk_size=256, time_chunk=1, compression="zstd", band_names=None):
+    if zarr is None:
+        raise ImportError("Writing a data cube requires zarr (pip install zarr).")
+    return {
+        "path": cube_path,
+        "bounds": bounds,
+        "chunk_size": chunk_size,
+        "time_chunk": time_chunk,
+        "compression": compression,
+        "band_names": band_names,
+    }
+
+
+# Exclusive lock between the processes writing into the same cube; the lock files live next to the cube, zarr
+# would warn about foreign files inside it
+@contextmanager
+def cube_lock(cube_path, name):
+    lock_folder = f"{cube_path.rstrip(os.sep)}.locks"
+    os.makedirs(lock_folder, exist_ok=True)
+    with open(os.path.join(lock_folder, name), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def compressors(compression):
+    if compression == "none":
+        return None
+    return [zarr.codecs.BloscCodec(cname=compression, clevel=5, shuffle="bitshuffle")]
+
+
+# Create the arrays of a new cube on the grid of its bounds at the resolution of the first raster written into it
+def create_cube(group, settings, src):
+    resolution = src.res[0]
+    minx, miny, maxx, maxy = settings["bounds"]
+    width = math.ceil((maxx - minx) / resolution - 1e-9)
+    height = math.ceil((maxy - miny) / resolution - 1e-9)
+    chunk = settings["chunk_size"]
+    data = group.create_array(
+        "data",
+        shape=(0, src.count, height, width),
+        chunks=(settings["time_chunk"], src.count, chunk, chunk),
+        dtype=src.dtypes[0],
+        fill_value=src.nodata if src.nodata is not None else 0,
+        compressors=compressors(settings["compression"]),
+        dimension_names=("time", "band", "y", "x"),
+    )
+    data.attrs.update(
+        {
+            "crs": src.crs.to_wkt(),
+            "transform": [minx, resolution, 0.0, maxy, 0.0, -resolution],
+            "bands": settings["band_names"] or [str(band) for band in range(1, src.count + 1)],
+        }
+    )
+    time = group.create_array("time", shape=(0,), chunks=(1024,), dtype="int64", dimension_names=("time",))
+    time.attrs.update({"units": "days since 1970-01-01", "calendar": "proleptic_gregorian"})
+    x = group.create_array("x", shape=(width,), chunks=(width,), dtype="float64", dimension_names=("x",))
+    x[:] = minx + (np.arange(width) + 0.5) * resolution
+    y = group.create_array("y", shape=(height,), chunks=(height,), dtype="float64", dimension_names=("y",))
+    y[:] = maxy - (np.arange(height) + 0.5) * resolution
+
+
+# Index of a date on the time axis, appending it if it is new. Dates stay in the order they were written, inserting
+# one would move every later slice; the "sorted_order" attribute of the time array lists the indices in
+# chronological order, so data[time.attrs["sorted_order"]] (or xarray's sortby("time")) reads a monotonic axis
+def time_index(group, day):
+    time = group["time"]
+    days = time[:]
+    if day in days:
+        return int(np.flatnonzero(days == day)[0])
+    data = group["data"]
+    index = time.shape[0]
+    time.resize((index + 1,))
+    time[index] = day
+    data.resize((index + 1, *data.shape[1:]))
+    time.attrs["sorted_order"] = np.argsort(np.append(days, day), kind="stable").tolist()
+    return index
+
+
+# Pixel offset of a raster in the cube; the raster has to lie on the pixel lattice of the cube
+def cube_offset(data, src):
+    minx, resolution, _, maxy, _, _ = data.attrs["transform"]
+    if not math.isclose(src.res[0], resolution) or not math.isclose(src.res[1], resolution):
+        raise ValueError(f"Resolution {src.res} does not match the cube resolution {resolution}.")
+    if rasterio.crs.CRS.from_wkt(data.attrs["crs"]) != src.crs:
+        raise ValueError(f"CRS {src.crs} does not match the CRS of the cube.")
+    col = (src.transform.c - minx) / resolution
+    row = (maxy - src.transform.f) / resolution
+    if not math.isclose(col, round(col), abs_tol=1e-6) or not math.isclose(row, round(row), abs_tol=1e-6):
+        raise ValueError("The raster is not aligned with the cube grid; snap it with --grid_origin.")
+    return round(col), round(row)
+
+
+# Write a raster into the cube at its date. The cube is created by the first writer; growing the time axis is
+# serialised by a lock over the whole cube, writing the pixels by a lock per time chunk, so workers writing
+# different dates never wait for each other. Valid pixels of several rasters of the same date are merged.
+def write_to_cube(settings, raster_path, date):
+    cube_path = settings["path"]
+    day = (datetime.strptime(date, "%Y%m%d") - EPOCH).days
+    with rasterio.open(raster_path) as src:
+        with cube_lock(cube_path, "metadata"):
+            group = zarr.open_group(cube_path, mode="a")
+            if "data" not in group:
+                create_cube(group, settings, src)
+            index = time_index(group, day)
+
+        data = zarr.open_group(cube_path, mode="r+")["data"]
+        col_off, row_off = cube_offset(data, src)
+        height, width = data.shape[2:]
+        nodata = data.fill_value
+        # The part of the raster inside the cube, in cube pixel coordinates
+        col_start, row_start = max(col_off, 0), max(row_off, 0)
+        col_end, row_end = min(col_off + src.width, width), min(row_off + src.height, height)
+        if col_start >= col_end or row_start >= row_end:
+            print(f"{os.path.basename(raster_path)} lies outside the cube, skipping it")
+            return
+
+        chunk = data.chunks[2]
+        with cube_lock(cube_path, f"time_{index // data.chunks[0]}"):
+            # Blocks aligned with the chunks keep the memory bounded and rewrite every chunk only once
+            for block_row in range(row_start - row_start % chunk, row_end, chunk):
+                for block_col in range(col_start - col_start % chunk, col_end, chunk):
+                    top, bottom = max(block_row, row_start), min(block_row + chunk, row_end)
+                    left, right = max(block_col, col_start), min(block_col + chunk, col_end)
+                    values = src.read(window=Window(left - col_off, top - row_off, right - left, bottom - top))
+                    current = data[index, :, top:bottom, left:right]
+                    data[index, :, top:bottom, left:right] = np.where(values != nodata, values, current)
+    print(f"{os.path.basename(raster_path)} written to the data cube {cube_path} ({date})")
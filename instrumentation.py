@@ -0,0 +1,289 @@
+# stage-level instrumentation shared by resampling.py and mosaic_tifs.py: timed spans with bytes read and written
+# and peak memory, accumulated stage times of hot loops, queue depths and resource samples, emitted as JSON lines
+# and summarised at the end of a run, optionally as a Prometheus textfile
+
+import os
+import json
+import socket
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Thread, Lock
+import psutil
+
+# The event file is passed through the environment, so worker processes emit into the same file
+METRICS_ENV = "RSDATA_METRICS_PATH"
+SAMPLE_INTERVAL = 0.1
+
+STATE = {}
+
+
+# Fresh state for this process. A forked worker starts from a copy of the parent's, with the lock possibly held by a
+# thread that does not exist in the child, the spans and totals of the parent and without the sampler thread
+def reset_state():
+    STATE.update(
+        {"lock": Lock(), "active": {}, "totals": defaultdict(float), "counts": defaultdict(int), "sampler": None}
+    )
+
+
+reset_state()
+os.register_at_fork(after_in_child=reset_state)
+
+
+def metrics_enabled():
+    return METRICS_ENV in os.environ
+
+
+# Start a new event file for this run; with only a Prometheus textfile the events are kept next to it
+def configure_metrics(metrics_path=None, prometheus_path=None):
+    if not metrics_path and not prometheus_path:
+        return None
+    events_path = os.path.abspath(metrics_path or f"{prometheus_path}.events.jsonl")
+    open(events_path, "w").close()
+    os.environ[METRICS_ENV] = events_path
+    return events_path
+
+
+def emit(record):
+    record["pid"] = os.getpid()
+    record["host"] = socket.gethostname()
+    # Single appended lines stay intact when several processes write into the same file
+    with open(os.environ[METRICS_ENV], "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def io_counters(process):
+    # io_counters is not available on every platform (e.g. macOS)
+    if hasattr(process, "io_counters"):
+        counters = process.io_counters()
+        return counters.read_bytes, counters.write_bytes
+    return 0, 0
+
+
+# Sample the RSS of the process for the peak memory of every open span
+def sample_memory():
+    process = psutil.Process(os.getpid())
+    while True:
+        rss = process.memory_info().rss
+        with STATE["lock"]:
+            for record in STATE["active"].values():
+                record["peak_rss"] = max(record["peak_rss"], rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def ensure_sampler():
+    with STATE["lock"]:
+        if STATE["sampler"] != os.getpid():
+            STATE["sampler"] = os.getpid()
+            Thread(target=sample_memory, daemon=True).start()
+
+
+# Time a stage of a scene, band or date; callers may add fields to the yielded record, e.g. "bytes" for the size of
+# what the stage produced. The I/O counters belong to the whole process, so read and written bytes are only
+# recorded with process_io, for spans that never run concurrently within their process (a scene in a worker, a
+# date, the catalogue); concurrent spans such as bands would each count the I/O of all the others
+@contextmanager
+def span(stage, process_io=False, **labels):
+    if not metrics_enabled():
+        yield {}
+        return
+    ensure_sampler()
+    process = psutil.Process(os.getpid())
+    if process_io:
+        read_before, written_before = io_counters(process)
+    record = {"event": "span", "stage": stage, "labels": labels, "peak_rss": process.memory_info().rss}
+    with STATE["lock"]:
+        STATE["active"][id(record)] = record
+    record["start"] = time.time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        with STATE["lock"]:
+            STATE["active"].pop(id(record))
+        if process_io:
+            read_after, written_after = io_counters(process)
+            record["read_bytes"] = read_after - read_before
+            record["write_bytes"] = written_after - written_before
+        emit(record)
+
+
+# Accumulate the time of a step that runs thousands of times (decoding, warping or writing one block), so it is
+# reported once per scene or date by flush_totals instead of once per call
+@contextmanager
+def timed(stage):
+    if not metrics_enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with STATE["lock"]:
+            STATE["totals"][stage] += elapsed
+            STATE["counts"][stage] += 1
+
+
+def flush_totals(scope, **labels):
+    if not metrics_enabled():
+        return
+    with STATE["lock"]:
+        seconds, counts = dict(STATE["totals"]), dict(STATE["counts"])
+        STATE["totals"].clear()
+        STATE["counts"].clear()
+    if seconds:
+        emit({"event": "totals", "stage": scope, "labels": labels, "seconds": seconds, "counts": counts})
+
+
+# Current depth of a queue, e.g. outputs waiting for the transfer or scenes waiting for a worker
+def gauge(name, value, **labels):
+    if metrics_enabled():
+        emit({"event": "gauge", "name": name, "value": value, "labels": labels, "time": time.time()})
+
+
+# CPU usage per core and RSS of the process at a fixed interval; without an event file a short line is printed
+def monitor_resources(stop_event, interval=1):
+    process = psutil.Process(os.getpid())
+    while not stop_event.is_set():
+        cpu_usages = psutil.cpu_percent(interval=interval, percpu=True)
+        rss = process.memory_info().rss
+        if metrics_enabled():
+            emit({"event": "resources", "cpu_percent": cpu_usages, "rss": rss, "time": time.time()})
+        else:
+            print(
+                f"CPU: {sum(cpu_usages) / len(cpu_usages):.0f}% average, {max(cpu_usages):.0f}% max core, "
+                f"Memory: {rss / (1024 * 1024):.0f} MB"
+            )
+
+
+def read_events(events_path):
+    events = []
+    with open(events_path) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line cut short by a killed worker
+                continue
+    return events
+
+
+def empty_stage():
+    return {
+        "count": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+        "bytes": 0,
+        "peak_rss": 0,
+        "process_io": False,
+    }
+
+
+def aggregate_events(events):
+    stages = defaultdict(empty_stage)
+    step_seconds = defaultdict(float)
+    step_counts = defaultdict(int)
+    queues = defaultdict(int)
+    cpu_samples = []
+    rss_samples = []
+    for event in events:
+        if event["event"] == "span":
+            stage = stages[event["stage"]]
+            stage["count"] += 1
+            stage["seconds"] += event["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], event["seconds"])
+            if "read_bytes" in event:
+                stage["process_io"] = True
+                stage["read_bytes"] += event["read_bytes"]
+                stage["write_bytes"] += event["write_bytes"]
+            stage["bytes"] += event.get("bytes", 0)
+            stage["peak_rss"] = max(stage["peak_rss"], event["peak_rss"])
+        elif event["event"] == "totals":
+            for step, seconds in event["seconds"].items():
+                step_seconds[step] += seconds
+                step_counts[step] += event["counts"].get(step, 0)
+        elif event["event"] == "gauge":
+            queues[event["name"]] = max(queues[event["name"]], event["value"])
+        elif event["event"] == "resources":
+            cpu_samples.append(sum(event["cpu_percent"]) / len(event["cpu_percent"]))
+            rss_samples.append(event["rss"])
+    return {
+        "stages": dict(stages),
+        "step_seconds": dict(step_seconds),
+        "step_counts": dict(step_counts),
+        "queues": dict(queues),
+        "cpu_samples": cpu_samples,
+        "rss_samples": rss_samples,
+    }
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def write_prometheus(summary, prometheus_path, job):
+    lines = []
+    metrics = [
+        ("stage_spans_total", "count", "Number of completed spans per stage"),
+        ("stage_seconds_total", "seconds", "Wall time of all spans per stage"),
+        ("stage_max_seconds", "max_seconds", "Longest span per stage"),
+        ("stage_read_bytes_total", "read_bytes", "Bytes read by the process during the spans"),
+        ("stage_write_bytes_total", "write_bytes", "Bytes written by the process during the spans"),
+        ("stage_output_bytes_total", "bytes", "Bytes produced by the stage"),
+        ("stage_peak_rss_bytes", "peak_rss", "Peak RSS of a process during a span"),
+    ]
+    for name, key, help_text in metrics:
+        lines.append(f"# HELP rsdata_{name} {help_text}")
+        metric_type = "counter" if name.endswith("_total") else "gauge"
+        lines.append(f"# TYPE rsdata_{name} {metric_type}")
+        for stage, values in sorted(summary["stages"].items()):
+            if key in ("read_bytes", "write_bytes") and not values["process_io"]:
+                continue
+            lines.append(f'rsdata_{name}{{job="{escape_label(job)}",stage="{escape_label(stage)}"}} {values[key]}')
+    lines.append("# HELP rsdata_step_seconds_total Accumulated thread time per processing step")
+    lines.append("# TYPE rsdata_step_seconds_total counter")
+    for step, seconds in sorted(summary["step_seconds"].items()):
+        lines.append(f'rsdata_step_seconds_total{{job="{escape_label(job)}",step="{escape_label(step)}"}} {seconds}')
+    lines.append("# HELP rsdata_queue_depth_max Maximum observed queue depth")
+    lines.append("# TYPE rsdata_queue_depth_max gauge")
+    for queue, depth in sorted(summary["queues"].items()):
+        lines.append(f'rsdata_queue_depth_max{{job="{escape_label(job)}",queue="{escape_label(queue)}"}} {depth}')
+    # The textfile collector may read at any moment, so the file is replaced atomically
+    with open(f"{prometheus_path}.tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(f"{prometheus_path}.tmp", prometheus_path)
+
+
+# Summarise the events of the run at its end and write the Prometheus textfile
+def report_metrics(job, prometheus_path=None):
+    if not metrics_enabled():
+        return None
+    summary = aggregate_events(read_events(os.environ[METRICS_ENV]))
+    print(f"Stage summary ({job}):")
+    for stage, values in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        io = ""
+        if values["process_io"]:
+            io = (
+                f"read {values['read_bytes'] / (1024 * 1024):.1f} MB, "
+                f"written {values['write_bytes'] / (1024 * 1024):.1f} MB, "
+            )
+        print(
+            f"  {stage}: {values['count']} x, {values['seconds']:.2f} s total, {values['max_seconds']:.2f} s max, "
+            f"{io}peak RSS {values['peak_rss'] / (1024 * 1024):.0f} MB"
+        )
+    for step, seconds in sorted(summary["step_seconds"].items(), key=lambda item: -item[1]):
+        print(f"  {step}: {seconds:.2f} thread seconds in {summary['step_counts'][step]} calls")
+    for queue, depth in sorted(summary["queues"].items()):
+        print(f"  max queue depth {queue}: {depth}")
+    if summary["cpu_samples"]:
+        print(
+            f"  CPU {sum(summary['cpu_samples']) / len(summary['cpu_samples']):.0f}% average, "
+            f"peak RSS {max(summary['rss_samples']) / (1024 * 1024):.0f} MB"
+        )
+    if prometheus_path:
+        write_prometheus(summary, prometheus_path, job)
+    return summary
@@ -0,0 +1,163 @@
+# persistent SQLite manifest of the processed scenes, so reruns skip finished work and redo changed or incomplete scenes,
+# and of the inputs of every mosaic, so mosaics can be updated incrementally
+
+import os
+import json
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+MANIFEST_NAME = ".resampling_manifest.sqlite"
+MOSAIC_MANIFEST_NAME = ".mosaic_manifest.sqlite"
+
+
+@contextmanager
+def open_manifest(manifest_path):
+    # A short-lived connection per call keeps the manifest usable from the main process, the scene worker
+    # processes and the transfer thread alike; SQLite's file locking serialises their writes
+    conn = sqlite3.connect(manifest_path, timeout=60)
+    try:
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scenes ("
+                "scene TEXT PRIMARY KEY, fingerprint TEXT, params TEXT, output_path TEXT, checksum TEXT, "
+                "state TEXT NOT NULL, updated REAL NOT NULL, valid_fraction REAL)"
+            )
+            # Manifests of older versions lack the valid fraction of the SCL masking
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(scenes)")]
+            if "valid_fraction" not in columns:
+                conn.execute("ALTER TABLE scenes ADD COLUMN valid_fraction REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS mosaic_inputs ("
+                "mosaic TEXT NOT NULL, input_path TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                "minx REAL, miny REAL, maxx REAL, maxy REAL, PRIMARY KEY (mosaic, input_path))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS mosaics (mosaic TEXT PRIMARY KEY, params TEXT NOT NULL)")
+            yield conn
+    finally:
+        conn.close()
+
+
+# Create the manifest; a new manifest adopts the outputs already in the final folder, which older versions
+# recognised by their file name only, so existing output folders are not processed again
+def init_manifest(manifest_path, final_output_folder, output_name_to_scene):
+    is_new = not os.path.exists(manifest_path)
+    with open_manifest(manifest_path) as conn:
+        if not is_new:
+            return
+        now = time.time()
+        adopted = 0
+        for entry in os.scandir(final_output_folder):
+            # Partial outputs of older versions were named *.part.tif
+            if not entry.is_file() or not entry.name.endswith(".tif") or entry.name.endswith(".part.tif"):
+                continue
+            conn.execute(
+                "INSERT OR IGNORE INTO scenes (scene, output_path, state, updated) VALUES (?, ?, 'done', ?)",
+                (output_name_to_scene(entry.name), entry.path, now),
+            )
+            adopted += 1
+    if adopted:
+        print(f"Manifest {manifest_path} angelegt, {adopted} vorhandene Ausgaben übernommen.")
+
+
+RECORD_COLUMNS = ("fingerprint", "params", "output_path", "checksum", "state")
+
+
+# One query for all records, so every scene is looked up in constant time afterwards
+def load_manifest(manifest_path):
+    with open_manifest(manifest_path) as conn:
+        rows = conn.execute(f"SELECT scene, {', '.join(RECORD_COLUMNS)} FROM scenes").fetchall()
+    return {row[0]: dict(zip(RECORD_COLUMNS, row[1:])) for row in rows}
+
+
+# The current record of a single scene, e.g. after another node may have finished it
+def load_scene_record(manifest_path, scene):
+    with open_manifest(manifest_path) as conn:
+        row = conn.execute(f"SELECT {', '.join(RECORD_COLUMNS)} FROM scenes WHERE scene = ?", (scene,)).fetchone()
+    return dict(zip(RECORD_COLUMNS, row)) if row else None
+
+
+def update_scene(
+    manifest_path, scene, state, fingerprint=None, params=None, output_path=None, checksum=None, valid_fraction=None
+):
+    with open_manifest(manifest_path) as conn:
+        conn.execute(
+            "INSERT INTO scenes (scene, fingerprint, params, output_path, checksum, state, updated, valid_fraction) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(scene) DO UPDATE SET "
+            "fingerprint = COALESCE(excluded.fingerprint, fingerprint), "
+            "params = COALESCE(excluded.params, params), "
+            "output_path = COALESCE(excluded.output_path, output_path), "
+            "checksum = COALESCE(excluded.checksum, checksum), "
+            "valid_fraction = COALESCE(excluded.valid_fraction, valid_fraction), "
+            "state = excluded.state, updated = excluded.updated",
+            (scene, fingerprint, params, output_path, checksum, state, time.time(), valid_fraction),
+        )
+
+
+# Called by the transfer thread once an output has been moved to the final folder
+def record_moved_output(manifest_path, scene, output_path):
+    update_scene(manifest_path, scene, "done", output_path=output_path)
+
+
+# Hash of the (relative path, size, mtime) entries of the input files of a scene, as collected by
+# scene_catalog.scan_scene; changes whenever an input file is replaced
+def scene_fingerprint(files):
+    digest = hashlib.sha256()
+    for entry in sorted(files):
+        digest.update(repr(entry).encode())
+    return digest.hexdigest()
+
+
+def encode_params(params):
+    return json.dumps(params, sort_keys=True)
+
+
+# A scene is finished when its last run completed with the same inputs and parameters and its output still
+# exists, either where it was written or in the final folder it was moved to
+def is_scene_done(record, fingerprint, params, final_output_folder):
+    if record is None or record["state"] != "done":
+        return False
+    # Adopted outputs of older versions carry no fingerprint and parameters
+    if record["fingerprint"] not in (None, fingerprint) or record["params"] not in (None, params):
+        return False
+    output_path = record["output_path"]
+    return os.path.exists(output_path) or os.path.exists(
+        os.path.join(final_output_folder, os.path.basename(output_path))
+    )
+
+
+# Fraction of usable pixels of every scene that was masked with its SCL layer, as {scene: fraction}
+def load_valid_fractions(manifest_path):
+    with open_manifest(manifest_path) as conn:
+        rows = conn.execute("SELECT scene, valid_fraction FROM scenes WHERE valid_fraction IS NOT NULL").fetchall()
+    return dict(rows)
+
+
+# Inputs of a mosaic as {input path: (fingerprint, (minx, miny, maxx, maxy))}
+def load_mosaic_inputs(manifest_path, mosaic):
+    with open_manifest(manifest_path) as conn:
+        rows = conn.execute(
+            "SELECT input_path, fingerprint, minx, miny, maxx, maxy FROM mosaic_inputs WHERE mosaic = ?", (mosaic,)
+        ).fetchall()
+    return {input_path: (fingerprint, tuple(bounds)) for input_path, fingerprint, *bounds in rows}
+
+
+# Settings the mosaic was written with, or None for mosaics of older versions
+def load_mosaic_params(manifest_path, mosaic):
+    with open_manifest(manifest_path) as conn:
+        row = conn.execute("SELECT params FROM mosaics WHERE mosaic = ?", (mosaic,)).fetchone()
+    return row[0] if row else None
+
+
+# Replace the recorded inputs and settings of a mosaic after it has been written
+def save_mosaic_inputs(manifest_path, mosaic, inputs, params):
+    with open_manifest(manifest_path) as conn:
+        conn.execute("INSERT OR REPLACE INTO mosaics (mosaic, params) VALUES (?, ?)", (mosaic, params))
+        conn.execute("DELETE FROM mosaic_inputs WHERE mosaic = ?", (mosaic,))
+        conn.executemany(
+            "INSERT INTO mosaic_inputs (mosaic, input_path, fingerprint, minx, miny, maxx, maxy) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(mosaic, input_path, fingerprint, *bounds) for input_path, (fingerprint, bounds) in inputs.items()],
+        )
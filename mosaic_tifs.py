@@ -7,70 +7,768 @@ from tqdm import tqdm
 import argparse
 import time
 import psutil
-from osgeo import gdal
+from osgeo import gdal, gdal_array, ogr, osr
 import uuid
+import math
+import hashlib
+import json
+import numpy as np
+from threading import Lock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from aoi import intersect_bounds, load_aoi
+from data_cube import CUBE_COMPRESSIONS, cube_settings, write_to_cube
+from manifest import (
+    MANIFEST_NAME, MOSAIC_MANIFEST_NAME, encode_params, load_mosaic_inputs, load_mosaic_params, load_valid_fractions,
+    save_mosaic_inputs,
+)
+from instrumentation import configure_metrics, flush_totals, gauge, monitor_resources, report_metrics, span, timed
+from work_claims import claim_work, finish_work, release_work, start_claims, stop_claims, work_record
+from output_profiles import (
+    OUTPUT_PROFILES, creation_options, gdal_option_list, output_driver, output_report, time_window_reads,
+)
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    # Without rtree the footprints are searched linearly, which is fine for the usual few dozen inputs of a date
+    rtree_index = None
+
+gdal.UseExceptions()
+
+# Bytes of the scene stack a composite holds at once; partitions are composited in strips of rows of that size, as
+# the stack and its working copies (about four times the stack for the median) grow with the overlapping scenes
+COMPOSITE_STACK_BYTES = 16 * 1024 * 1024
 
 # List all files with a specific extension in a folder
 def list_extension(folder, extension):
     return [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(f".{extension}")]
 
+# Warper threads per warp: all CPUs, unless a date worker was given its share through GDAL_NUM_THREADS; warps
+# running side by side split those threads between them
+def warp_threads(concurrent_warps=1):
+    threads = os.environ.get("GDAL_NUM_THREADS", "ALL_CPUS")
+    if concurrent_warps <= 1:
+        return threads
+    total = (os.cpu_count() or 1) if threads == "ALL_CPUS" else int(threads)
+    return str(max(1, total // concurrent_warps))
+
+# Give a date worker process its share of the CPU threads and of the GDAL block cache; the environment is also
+# inherited by the gdalwarp subprocesses
+def init_date_worker(threads, cache_mb=None):
+    os.environ["GDAL_NUM_THREADS"] = str(threads)
+    if cache_mb:
+        os.environ["GDAL_CACHEMAX"] = str(cache_mb)
+        gdal.SetCacheMax(cache_mb * 1024 * 1024)
+
 # Transform a TIF file to a specified EPSG coordinate system
-def transform_to_epsg(input_file, output_file, epsg="EPSG:32633", nodata_value=0):
+def transform_to_epsg(input_file, output_file, epsg="EPSG:32633", nodata_value=0, threads=None):
     cmd_warp = [
         "gdalwarp",
         "-t_srs", epsg,
         "-multi",
-        "-wo", "NUM_THREADS=ALL_CPUS",
+        "-wo", f"NUM_THREADS={threads or warp_threads()}",
         "-srcnodata", str(nodata_value),
         "-dstnodata", str(nodata_value),
         input_file, output_file,
     ]
     subprocess.run(cmd_warp, check=True)
 
-# Check and transform the coordinate system of TIF files if necessary
-def check_and_transform_crs(tif_files, temp_folder, epsg="EPSG:32633", nodata_value=0):
-    transformed_files = []
-    for tif in tif_files:
-        dataset = gdal.Open(tif)
-        crs = dataset.GetProjection()
-        if epsg not in crs:
-            unique_suffix = uuid.uuid4().hex
-            transformed_file = os.path.join(temp_folder, os.path.basename(tif).replace(".tif", f"_transformed_{unique_suffix}.tif"))
-            transform_to_epsg(tif, transformed_file, epsg, nodata_value)
-            transformed_files.append(transformed_file)
-        else:
-            # Copy the file to the temp folder to ensure all processing happens there
-            temp_file = os.path.join(temp_folder, os.path.basename(tif))
-            shutil.copy(tif, temp_file)
-            transformed_files.append(temp_file)
-    return transformed_files
+# Check whether a dataset is in the given coordinate system; the WKT of a projection never contains "EPSG:xxxx"
+# itself, so the spatial references are compared
+def has_crs(dataset, epsg):
+    target = osr.SpatialReference()
+    target.SetFromUserInput(epsg)
+    source = dataset.GetSpatialRef()
+    return source is not None and bool(source.IsSame(target))
+
+# Transform a TIF file into the temp folder if its coordinate system differs, otherwise copy it there
+def check_and_transform_file(tif, temp_folder, epsg="EPSG:32633", nodata_value=0, threads=None):
+    dataset = gdal.Open(tif)
+    in_crs = has_crs(dataset, epsg)
+    dataset = None
+    if not in_crs:
+        unique_suffix = uuid.uuid4().hex
+        transformed_name = os.path.basename(tif).replace(".tif", f"_transformed_{unique_suffix}.tif")
+        transformed_file = os.path.join(temp_folder, transformed_name)
+        transform_to_epsg(tif, transformed_file, epsg, nodata_value, threads)
+        return transformed_file
+    # Copy the file to the temp folder to ensure all processing happens there
+    temp_file = os.path.join(temp_folder, os.path.basename(tif))
+    shutil.copy(tif, temp_file)
+    return temp_file
+
+# Check and transform the coordinate system of TIF files if necessary, several files at once; the gdalwarp calls
+# share the warper threads instead of each using all of them
+def check_and_transform_crs(tif_files, temp_folder, epsg="EPSG:32633", nodata_value=0, max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    threads = warp_threads(min(max_workers, len(tif_files)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda tif: check_and_transform_file(tif, temp_folder, epsg, nodata_value, threads), tif_files
+        ))
+
+# NumPy data type of the first band of a TIF file
+def input_dtype(tif):
+    dataset = gdal.Open(tif)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+    dataset = None
+    return dtype
 
 # Merge multiple TIF files into one using gdalwarp
-def gdal_warp_merge(input_files, output_file, nodata_value=0):
+def gdal_warp_merge(input_files, output_file, nodata_value=0, output_profile="lzw", tile_size=512):
+    options = creation_options(output_profile, input_dtype(input_files[0]), tile_size)
     cmd_warp = [
         "gdalwarp",
         "-multi",
-        "-wo", "NUM_THREADS=ALL_CPUS",
+        "-wo", f"NUM_THREADS={warp_threads()}",
         "-srcnodata", str(nodata_value),
         "-dstnodata", str(nodata_value),
-        "-co", "BIGTIFF=YES",
-        "-co", "COMPRESS=LZW",
+        "-of", output_driver(output_profile),
         "-overwrite",
-    ] + input_files + [output_file]
+    ]
+    for option in gdal_option_list(options):
+        cmd_warp += ["-co", option]
+    cmd_warp += input_files + [output_file]
     subprocess.run(cmd_warp, check=True)
 
+# Merge pixel-aligned TIF files through a VRT, which copies the pixels without any resampling
+def gdal_translate_merge(input_files, output_file, nodata_value=0, output_profile="lzw", tile_size=512):
+    options = creation_options(output_profile, input_dtype(input_files[0]), tile_size)
+    vrt_path = f"/vsimem/{uuid.uuid4().hex}.vrt"
+    vrt = gdal.BuildVRT(vrt_path, input_files, srcNodata=nodata_value, VRTNodata=nodata_value)
+    gdal.Translate(output_file, vrt, format=output_driver(output_profile), creationOptions=gdal_option_list(options))
+    vrt = None
+    gdal.Unlink(vrt_path)
+
+# Print size, write and window read time of an output
+def report_output(output_file, output_profile, write_seconds, read_seconds):
+    report = output_report(output_file, output_profile, write_seconds, read_seconds)
+    print(
+        f"Output profile {report['profile']}: {report['size_mb']:.1f} MB, write {report['write_seconds']:.2f} s, "
+        f"window read {report['read_ms']:.1f} ms ({report['name']})"
+    )
+
+# Average time to read a few tile-sized windows of the output
+def time_output_reads(output_file, tile_size=512):
+    dataset = gdal.Open(output_file)
+    seconds = time_window_reads(
+        lambda col_off, row_off, width, height: dataset.ReadAsArray(col_off, row_off, width, height),
+        dataset.RasterXSize,
+        dataset.RasterYSize,
+        tile_size,
+    )
+    dataset = None
+    return seconds
+
+# Check whether all TIF files share projection, band count and pixel size and lie on one pixel grid
+def inputs_are_aligned(tif_files):
+    reference = None
+    for tif in tif_files:
+        dataset = gdal.Open(tif)
+        projection = dataset.GetProjection()
+        geotransform = dataset.GetGeoTransform()
+        band_count = dataset.RasterCount
+        dataset = None
+        if geotransform[2] != 0 or geotransform[4] != 0:
+            return False
+        if reference is None:
+            reference = (projection, geotransform, band_count)
+            continue
+        ref_projection, ref_geotransform, ref_band_count = reference
+        if projection != ref_projection or band_count != ref_band_count:
+            return False
+        if not math.isclose(geotransform[1], ref_geotransform[1]):
+            return False
+        if not math.isclose(geotransform[5], ref_geotransform[5]):
+            return False
+        offsets = (
+            (geotransform[0] - ref_geotransform[0], geotransform[1]),
+            (geotransform[3] - ref_geotransform[3], geotransform[5]),
+        )
+        for offset, pixel_size in offsets:
+            steps = offset / pixel_size
+            if abs(steps - round(steps)) > 1e-6:
+                return False
+    return True
+
+# Merge TIF files, skipping the warp when the inputs already share one pixel grid
+def merge_tifs(input_files, output_file, nodata_value=0, output_profile="lzw", tile_size=512):
+    if inputs_are_aligned(input_files):
+        print("Inputs are pixel-aligned, merging without warping")
+        gdal_translate_merge(input_files, output_file, nodata_value, output_profile, tile_size)
+    else:
+        gdal_warp_merge(input_files, output_file, nodata_value, output_profile, tile_size)
+
+# Merge the final mosaic of a date with the selected output profile and report size, write and read time
+def merge_final(input_files, output_file, nodata_value, output_profile, tile_size):
+    write_start = time.perf_counter()
+    merge_tifs(input_files, output_file, nodata_value, output_profile, tile_size)
+    write_seconds = time.perf_counter() - write_start
+    report_output(output_file, output_profile, write_seconds, time_output_reads(output_file, tile_size))
+
+# Reference TIF files in the target CRS without copying them: inputs already in the CRS are used in place, all others
+# are reprojected lazily through warped VRTs in memory; returns the sources and the in-memory VRTs to unlink
+def open_sources(tif_files, epsg="EPSG:32633", nodata_value=0):
+    sources = []
+    vrt_paths = []
+    for tif in tif_files:
+        # Absolute paths, since the VRTs live in /vsimem and cannot resolve paths relative to themselves
+        tif = os.path.abspath(tif)
+        dataset = gdal.Open(tif)
+        if has_crs(dataset, epsg):
+            sources.append(tif)
+        else:
+            warped_path = f"/vsimem/{uuid.uuid4().hex}_warped.vrt"
+            vrt_paths.append(warped_path)
+            # The warped VRT only stores the warp parameters, the pixels are reprojected while the output is read
+            gdal.Warp(
+                warped_path,
+                dataset,
+                format="VRT",
+                dstSRS=epsg,
+                srcNodata=nodata_value,
+                dstNodata=nodata_value,
+                multithread=True,
+                warpOptions=[f"NUM_THREADS={warp_threads()}"],
+            )
+            sources.append(warped_path)
+        dataset = None
+    return sources, vrt_paths
+
+# Footprint (minx, miny, maxx, maxy) of a north-up raster
+def source_bounds(source):
+    dataset = gdal.Open(source)
+    geotransform = dataset.GetGeoTransform()
+    maxx = geotransform[0] + dataset.RasterXSize * geotransform[1]
+    miny = geotransform[3] + dataset.RasterYSize * geotransform[5]
+    dataset = None
+    return (geotransform[0], miny, maxx, geotransform[3])
+
+# R-tree over the footprints of the sources, or None when the optional rtree package is missing
+def build_footprint_index(footprints):
+    if rtree_index is None:
+        return None
+    index = rtree_index.Index()
+    for source_id, bounds in enumerate(footprints):
+        index.insert(source_id, bounds)
+    return index
+
+# Ids of the sources overlapping the bounds, in input order so later inputs still win where they overlap
+def query_footprints(index, footprints, bounds):
+    if index is not None:
+        return sorted(index.intersection(bounds))
+    minx, miny, maxx, maxy = bounds
+    return [
+        source_id
+        for source_id, (source_minx, source_miny, source_maxx, source_maxy) in enumerate(footprints)
+        if source_minx < maxx and source_maxx > minx and source_miny < maxy and source_maxy > miny
+    ]
+
+# Windows (col_off, row_off, width, height) that split the output into square partitions
+def plan_partitions(width, height, partition_size):
+    return [
+        (col_off, row_off, min(partition_size, width - col_off), min(partition_size, height - row_off))
+        for row_off in range(0, height, partition_size)
+        for col_off in range(0, width, partition_size)
+    ]
+
+# Read sources over the bounds of a partition on the output grid; a single VRT over several sources resolves
+# overlaps by draw order, so the last valid pixel wins
+def read_partition(sources, bounds, geotransform, nodata_value):
+    vrt = gdal.BuildVRT(
+        "",
+        sources,
+        outputBounds=bounds,
+        xRes=geotransform[1],
+        yRes=-geotransform[5],
+        srcNodata=nodata_value,
+        VRTNodata=nodata_value,
+    )
+    data = vrt.ReadAsArray()
+    vrt = None
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    return data
+
+# Combine a stack (scenes, bands, rows, cols) of overlapping scenes pixel by pixel, ignoring nodata; first, last and
+# max_ndvi pick whole pixels of one scene, the statistics are computed per band
+def composite_stack(stack, method, nodata_value=0, red_band=3, nir_band=7):
+    valid = stack != nodata_value
+    if method in ("first", "last", "max_ndvi"):
+        pixel_valid = valid.any(axis=1)
+        if method == "first":
+            # argmax returns the first maximum, i.e. the first valid scene
+            selected = pixel_valid.argmax(axis=0)
+        elif method == "last":
+            selected = stack.shape[0] - 1 - pixel_valid[::-1].argmax(axis=0)
+        else:
+            red = stack[:, red_band - 1].astype(np.float32)
+            nir = stack[:, nir_band - 1].astype(np.float32)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ndvi = (nir - red) / (nir + red)
+            ndvi[~pixel_valid | np.isnan(ndvi)] = -np.inf
+            selected = ndvi.argmax(axis=0)
+        result = np.take_along_axis(stack, selected[np.newaxis, np.newaxis], axis=0)[0]
+        result[:, ~pixel_valid.any(axis=0)] = nodata_value
+        return result
+
+    count = valid.sum(axis=0)
+    if method in ("min", "max"):
+        limits = np.finfo(stack.dtype) if np.issubdtype(stack.dtype, np.floating) else np.iinfo(stack.dtype)
+        if method == "min":
+            result = np.where(valid, stack, limits.max).min(axis=0)
+        else:
+            result = np.where(valid, stack, limits.min).max(axis=0)
+    else:
+        if method == "mean":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.where(valid, stack, 0).sum(axis=0, dtype=np.float64) / count
+        else:
+            # One float32 copy sorted in place with the nodata pixels as NaN at the end; np.nanmedian holds several
+            # copies of the stack
+            values = stack.astype(np.float32)
+            values[~valid] = np.nan
+            values.sort(axis=0)
+            # The two middle values of the valid ones, the same for an odd count; pixels without any valid scene
+            # stay NaN and become nodata below
+            lower = np.maximum(count - 1, 0) // 2
+            values = (
+                np.take_along_axis(values, lower[np.newaxis], axis=0)[0]
+                + np.take_along_axis(values, (count // 2)[np.newaxis], axis=0)[0]
+            ) / 2
+        if not np.issubdtype(stack.dtype, np.floating):
+            values = np.rint(values)
+        result = np.nan_to_num(values, nan=nodata_value).astype(stack.dtype)
+    result[count == 0] = nodata_value
+    return result
+
+# Write the AOI, transformed into the target CRS, as GeoJSON into memory for rasterizing; returns its path and bounds
+def write_aoi(aoi, epsg="EPSG:32633"):
+    source = osr.SpatialReference()
+    source.SetFromUserInput(aoi["crs"])
+    target = osr.SpatialReference()
+    target.SetFromUserInput(epsg)
+    # GeoJSON coordinates are always x, y (longitude, latitude)
+    source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(source, target)
+
+    features = []
+    envelopes = []
+    for geometry_dict in aoi["geometries"]:
+        geometry = ogr.CreateGeometryFromJson(json.dumps(geometry_dict))
+        geometry.Transform(transformation)
+        envelopes.append(geometry.GetEnvelope())
+        features.append({"type": "Feature", "properties": {}, "geometry": json.loads(geometry.ExportToJson())})
+
+    aoi_path = f"/vsimem/{uuid.uuid4().hex}_aoi.geojson"
+    gdal.FileFromMemBuffer(aoi_path, json.dumps({"type": "FeatureCollection", "features": features}))
+    bounds = (
+        min(envelope[0] for envelope in envelopes),
+        min(envelope[2] for envelope in envelopes),
+        max(envelope[1] for envelope in envelopes),
+        max(envelope[3] for envelope in envelopes),
+    )
+    return aoi_path, bounds
+
+# Boolean mask of the pixels of a partition that lie inside the AOI
+def aoi_mask(aoi_path, bounds, geotransform, width, height):
+    mask = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Byte)
+    mask.SetGeoTransform((bounds[0], geotransform[1], 0, bounds[3], 0, geotransform[5]))
+    gdal.Rasterize(mask, aoi_path, burnValues=[1])
+    inside = mask.ReadAsArray().astype(bool)
+    mask = None
+    return inside
+
+# Georeferenced bounds (minx, miny, maxx, maxy) of a pixel window of the output grid
+def partition_bounds(geotransform, window):
+    col_off, row_off, width, height = window
+    minx = geotransform[0] + col_off * geotransform[1]
+    maxy = geotransform[3] + row_off * geotransform[5]
+    return (minx, maxy + height * geotransform[5], minx + width * geotransform[1], maxy)
+
+# Mosaic one partition from only the sources that overlap it and write it into the output; the memory of a
+# partition is bounded by its size times the number of overlapping sources, independent of the size of the scenes
+def mosaic_partition(
+    sources, footprints, index, geotransform, window, nodata_value, output, write_lock,
+    composite="last", red_band=3, nir_band=7, fill_empty=False, aoi_path=None,
+):
+    col_off, row_off, width, height = window
+    bounds = partition_bounds(geotransform, window)
+    source_ids = query_footprints(index, footprints, bounds)
+    inside = None
+    if source_ids and aoi_path:
+        inside = aoi_mask(aoi_path, bounds, geotransform, width, height)
+        if not inside.any():
+            # Partitions outside the AOI polygons are never read
+            source_ids = []
+    if not source_ids and not fill_empty:
+        # Untouched tiles of a new output are filled with the nodata value
+        return False
+
+    if not source_ids:
+        # An updated output may still hold pixels of removed inputs here
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(output.GetRasterBand(1).DataType)
+        data = np.full((output.RasterCount, height, width), nodata_value, dtype=dtype)
+    elif composite == "last":
+        with timed("read"):
+            data = read_partition([sources[source_id] for source_id in source_ids], bounds, geotransform, nodata_value)
+    else:
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(output.GetRasterBand(1).DataType)
+        data = np.empty((output.RasterCount, height, width), dtype=dtype)
+        row_bytes = len(source_ids) * output.RasterCount * width * np.dtype(dtype).itemsize
+        rows = max(1, COMPOSITE_STACK_BYTES // row_bytes)
+        for top in range(0, height, rows):
+            strip = (col_off, row_off + top, width, min(rows, height - top))
+            strip_bounds = partition_bounds(geotransform, strip)
+            with timed("read"):
+                stack = np.stack([
+                    read_partition([sources[source_id]], strip_bounds, geotransform, nodata_value)
+                    for source_id in source_ids
+                ])
+            with timed("composite"):
+                data[:, top:top + strip[3]] = composite_stack(stack, composite, nodata_value, red_band, nir_band)
+            stack = None
+    if source_ids and inside is not None:
+        data[:, ~inside] = nodata_value
+
+    with write_lock, timed("write"):
+        for band_index in range(data.shape[0]):
+            output.GetRasterBand(band_index + 1).WriteArray(data[band_index], col_off, row_off)
+        # Write the finished tiles right away instead of leaving dirty blocks in the shared GDAL cache
+        output.FlushCache()
+    return True
+
+# Mosaic the given partitions in parallel and return how many of them were written
+def mosaic_partitions(
+    windows, sources, footprints, index, geotransform, nodata_value, output,
+    mosaic_workers=None, composite="last", red_band=3, nir_band=7, fill_empty=False, aoi_path=None,
+):
+    write_lock = Lock()
+    with ThreadPoolExecutor(max_workers=mosaic_workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                mosaic_partition, sources, footprints, index, geotransform, window, nodata_value, output, write_lock,
+                composite=composite, red_band=red_band, nir_band=nir_band, fill_empty=fill_empty, aoi_path=aoi_path,
+            )
+            for window in windows
+        ]
+        return sum(future.result() for future in tqdm(futures, desc="Mosaicking partitions"))
+
+# Output grid of the mosaic of the sources, optionally cropped to bounds on the same pixel grid; the VRT only defines
+# the grid, no pixels are read from it. None when the crop is empty
+def mosaic_grid(sources, nodata_value=0, bounds=None):
+    vrt = gdal.BuildVRT("", sources, srcNodata=nodata_value, VRTNodata=nodata_value)
+    grid = {
+        "geotransform": vrt.GetGeoTransform(),
+        "width": vrt.RasterXSize,
+        "height": vrt.RasterYSize,
+        "band_count": vrt.RasterCount,
+        "projection": vrt.GetProjection(),
+        "data_type": vrt.GetRasterBand(1).DataType,
+    }
+    vrt = None
+    if bounds is not None:
+        geotransform = grid["geotransform"]
+        col_start = max(0, math.floor((bounds[0] - geotransform[0]) / geotransform[1]))
+        col_end = min(grid["width"], math.ceil((bounds[2] - geotransform[0]) / geotransform[1]))
+        row_start = max(0, math.floor((bounds[3] - geotransform[3]) / geotransform[5]))
+        row_end = min(grid["height"], math.ceil((bounds[1] - geotransform[3]) / geotransform[5]))
+        if col_start >= col_end or row_start >= row_end:
+            return None
+        grid["geotransform"] = (
+            geotransform[0] + col_start * geotransform[1], geotransform[1], 0,
+            geotransform[3] + row_start * geotransform[5], 0, geotransform[5],
+        )
+        grid["width"] = col_end - col_start
+        grid["height"] = row_end - row_start
+    return grid
+
+# Open the sources of a mosaic and plan its grid. With an AOI only the inputs intersecting its bounds are used and the
+# grid is cropped to the AOI; the grid is None when no input intersects it. The footprints of all inputs are kept
+# for the manifest
+def prepare_mosaic(tif_files, epsg="EPSG:32633", nodata_value=0, aoi=None):
+    sources, vrt_paths = open_sources(tif_files, epsg, nodata_value)
+    footprints = [source_bounds(source) for source in sources]
+    used = list(range(len(sources)))
+    aoi_path = None
+    aoi_bounds = None
+    if aoi is not None:
+        aoi_path, aoi_bounds = write_aoi(aoi, epsg)
+        vrt_paths.append(aoi_path)
+        used = [source_id for source_id in used if intersect_bounds(footprints[source_id], aoi_bounds)]
+        print(f"{len(used)} of {len(sources)} inputs intersect the AOI")
+    return {
+        "footprints": footprints,
+        "sources": [sources[source_id] for source_id in used],
+        "used_footprints": [footprints[source_id] for source_id in used],
+        "grid": mosaic_grid([sources[source_id] for source_id in used], nodata_value, aoi_bounds) if used else None,
+        "aoi_path": aoi_path,
+        "vrt_paths": vrt_paths,
+    }
+
+# Mosaic TIF files in process without copying them: the output extent is split into partitions that are mosaicked
+# in parallel from the inputs found through a footprint index, and only the final output is written; returns the
+# footprints of the inputs in the target CRS, or None when no input intersects the AOI
+def vrt_mosaic(
+    tif_files, output_file, epsg="EPSG:32633", nodata_value=0, output_profile="lzw", tile_size=512,
+    partition_size=4096, mosaic_workers=None, composite="last", red_band=3, nir_band=7, aoi=None,
+):
+    dtype = input_dtype(tif_files[0])
+    # Partitions cover whole output tiles, so every tile is compressed and written exactly once
+    partition_size = max(tile_size, partition_size // tile_size * tile_size)
+    mosaic = prepare_mosaic(tif_files, epsg, nodata_value, aoi)
+    try:
+        grid = mosaic["grid"]
+        if grid is None:
+            return None
+        sources, footprints = mosaic["sources"], mosaic["used_footprints"]
+        index = build_footprint_index(footprints)
+
+        # The partitions are written into a tiled GeoTIFF that only gets its final name once complete; COG outputs
+        # are translated from it afterwards. Part files do not end in .tif, so they are never taken as inputs
+        is_cog = output_driver(output_profile) == "COG"
+        write_file = f"{output_file}.part"
+        if is_cog:
+            options = creation_options("none", dtype, tile_size)
+        else:
+            options = creation_options(output_profile, dtype, tile_size)
+        options.update({"TILED": "YES", "BLOCKXSIZE": str(tile_size), "BLOCKYSIZE": str(tile_size)})
+        output = gdal.GetDriverByName("GTiff").Create(
+            write_file, grid["width"], grid["height"], grid["band_count"], grid["data_type"], gdal_option_list(options)
+        )
+        output.SetGeoTransform(grid["geotransform"])
+        output.SetProjection(grid["projection"])
+        for band_index in range(grid["band_count"]):
+            output.GetRasterBand(band_index + 1).SetNoDataValue(nodata_value)
+
+        windows = plan_partitions(grid["width"], grid["height"], partition_size)
+        written = mosaic_partitions(
+            windows, sources, footprints, index, grid["geotransform"], nodata_value, output,
+            mosaic_workers=mosaic_workers, composite=composite, red_band=red_band, nir_band=nir_band,
+            aoi_path=mosaic["aoi_path"],
+        )
+        output = None
+        search = "R-tree" if index is not None else "linear"
+        print(f"Mosaicked {written} of {len(windows)} partitions ({search} footprint search)")
+
+        if is_cog:
+            with span("cog", output=os.path.basename(output_file)):
+                options = gdal_option_list(creation_options(output_profile, dtype, tile_size))
+                gdal.Translate(f"{output_file}.cog.part", write_file, format="COG", creationOptions=options)
+            os.remove(write_file)
+            os.replace(f"{output_file}.cog.part", output_file)
+        else:
+            os.replace(write_file, output_file)
+        return mosaic["footprints"]
+    except BaseException:
+        # A failed mosaic leaves no partial output behind
+        output = None
+        for part_file in (f"{output_file}.part", f"{output_file}.cog.part"):
+            if os.path.exists(part_file):
+                os.remove(part_file)
+        raise
+    finally:
+        for vrt_path in mosaic["vrt_paths"]:
+            gdal.Unlink(vrt_path)
+
+# Size and modification time of an input, which change whenever the file is replaced
+def input_fingerprint(tif):
+    stat = os.stat(tif)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+# Inputs of a mosaic as recorded in the manifest: {absolute path: (fingerprint, footprint)}
+def mosaic_inputs(tif_files, fingerprints, footprints):
+    inputs = zip(tif_files, fingerprints, footprints)
+    return {os.path.abspath(tif): (fingerprint, bounds) for tif, fingerprint, bounds in inputs}
+
+# Rewrite in place only the partitions of an existing mosaic that intersect inputs added, replaced or removed since
+# it was written; returns the footprints of the inputs, or None when the output grid changed and the mosaic has to
+# be rebuilt from scratch
+def update_mosaic(
+    tif_files, fingerprints, previous_inputs, output_file, epsg="EPSG:32633", nodata_value=0, tile_size=512,
+    partition_size=4096, mosaic_workers=None, composite="last", red_band=3, nir_band=7, aoi=None,
+):
+    partition_size = max(tile_size, partition_size // tile_size * tile_size)
+    mosaic = prepare_mosaic(tif_files, epsg, nodata_value, aoi)
+    try:
+        grid = mosaic["grid"]
+        if grid is None:
+            return None
+        footprints = mosaic["footprints"]
+
+        output = gdal.OpenEx(output_file, gdal.OF_RASTER | gdal.OF_UPDATE)
+        output_shape = (output.RasterXSize, output.RasterYSize, output.RasterCount)
+        same_grid = (
+            output_shape == (grid["width"], grid["height"], grid["band_count"])
+            and all(math.isclose(a, b) for a, b in zip(output.GetGeoTransform(), grid["geotransform"]))
+        )
+        if not same_grid:
+            output = None
+            print("The extent or grid of the mosaic changed, rebuilding it")
+            return None
+
+        # Footprints of new and replaced inputs, of the replaced versions and of removed inputs
+        changed = []
+        current_inputs = set()
+        for tif, fingerprint, bounds in zip(tif_files, fingerprints, footprints):
+            input_path = os.path.abspath(tif)
+            current_inputs.add(input_path)
+            previous = previous_inputs.get(input_path)
+            if previous is None or previous[0] != fingerprint:
+                changed.append(bounds)
+                if previous is not None:
+                    changed.append(previous[1])
+        changed += [bounds for input_path, (_, bounds) in previous_inputs.items() if input_path not in current_inputs]
+
+        windows = [
+            window
+            for window in plan_partitions(grid["width"], grid["height"], partition_size)
+            if query_footprints(None, changed, partition_bounds(grid["geotransform"], window))
+        ]
+        index = build_footprint_index(mosaic["used_footprints"])
+        written = mosaic_partitions(
+            windows, mosaic["sources"], mosaic["used_footprints"], index, grid["geotransform"], nodata_value, output,
+            mosaic_workers=mosaic_workers, composite=composite, red_band=red_band, nir_band=nir_band,
+            fill_empty=True, aoi_path=mosaic["aoi_path"],
+        )
+        output = None
+        partitions = len(plan_partitions(grid["width"], grid["height"], partition_size))
+        print(f"Updated {written} of {partitions} partitions in place ({len(changed)} changed footprints)")
+        return footprints
+    finally:
+        for vrt_path in mosaic["vrt_paths"]:
+            gdal.Unlink(vrt_path)
+
+# Mosaic the files of a date the previous way: copy or transform every input into the temp folder, merge blocks of
+# block_size files and merge the block mosaics; returns the bytes written to the temp folder
+def copy_mosaic(
+    files, date, temp_folder, final_output_file, block_size=10, nodata_value=0, epsg="EPSG:32633",
+    output_profile="lzw", tile_size=512, transform_workers=None,
+):
+    transformed_files = check_and_transform_crs(files, temp_folder, epsg, nodata_value, transform_workers)
+    temp_bytes = sum(os.path.getsize(transformed_file) for transformed_file in transformed_files)
+
+    if len(transformed_files) <= block_size:
+        merge_final(transformed_files, final_output_file, nodata_value, output_profile, tile_size)
+    else:
+        blocks = [transformed_files[i:i + block_size] for i in range(0, len(transformed_files), block_size)]
+        block_mosaics = []
+
+        for block_num, block in enumerate(tqdm(blocks, desc="Processing blocks")):
+            block_mosaics.append(process_block(block, date, temp_folder, block_num, nodata_value))
+        temp_bytes += sum(os.path.getsize(block_file) for block_file in block_mosaics)
+
+        merge_final(block_mosaics, final_output_file, nodata_value, output_profile, tile_size)
+
+        # Delete temporary block files
+        for block_file in block_mosaics:
+            os.remove(block_file)
+
+        block_mosaics.clear()
+        psutil.virtual_memory()
+
+    # Delete temporary transformed files
+    for transformed_file in transformed_files:
+        os.remove(transformed_file)
+
+    return temp_bytes + os.path.getsize(final_output_file)
+
 # Process a block of TIF files and merge them
 def process_block(block, date, output_path, block_num, nodata_value=0):
     block_output_file = os.path.join(output_path, f"{date}_block_{block_num}.tif")
-    gdal_warp_merge(block, block_output_file, nodata_value)
+    merge_tifs(block, block_output_file, nodata_value)
     return block_output_file
 
 # Parse the date from the TIF file name
 def date_parser(tif):
     return os.path.basename(tif)[:8]
 
-# Combine TIF files based on their dates and coordinates
-def combine_tifs(tif_files, temp_folder, output_folder, block_size=10, nodata_value=0, epsg="EPSG:32633"):
+# Order the inputs by the fraction of usable pixels resampling.py recorded from the SCL layer, so the clearest scene
+# ends up on top (last, or first for the first composite), and drop inputs below min_valid_fraction. Inputs
+# without a recorded fraction keep the lowest priority
+def order_by_valid_fraction(tif_files, valid_fractions, min_valid_fraction=0.0, composite="last"):
+    # The outputs of resampling.py are named "YYYYMMDD_<scene>.tif"
+    fractions = {tif: valid_fractions.get(os.path.splitext(os.path.basename(tif))[0][9:]) for tif in tif_files}
+    kept = [tif for tif in tif_files if fractions[tif] is None or fractions[tif] >= min_valid_fraction]
+    if len(kept) < len(tif_files):
+        print(f"Dropped {len(tif_files) - len(kept)} inputs below a valid fraction of {min_valid_fraction:.1%}")
+    kept.sort(key=lambda tif: -1.0 if fractions[tif] is None else fractions[tif], reverse=composite == "first")
+    return kept
+
+# Settings that change the pixels of a mosaic; an incremental update with other settings would mix both in one
+# output. The AOI is recorded by a hash of its geometries, ordering describes how the inputs were sorted and filtered
+def get_mosaic_params(nodata_value, epsg, output_profile, tile_size, composite, red_band, nir_band, aoi, ordering):
+    aoi_hash = hashlib.sha256(json.dumps(aoi, sort_keys=True).encode()).hexdigest() if aoi is not None else None
+    return encode_params({
+        "nodata_value": nodata_value,
+        "epsg": epsg,
+        "output_profile": output_profile,
+        "tile_size": tile_size,
+        "composite": composite,
+        "red_band": red_band,
+        "nir_band": nir_band,
+        "aoi": aoi_hash,
+        "ordering": ordering,
+    })
+
+# Mosaic a date as one timed span; the read, composite and write times of its partitions are reported with it
+def run_date(date, files, date_kwargs):
+    try:
+        with span("date", process_io=True, date=date, inputs=len(files)):
+            process_date(date, files, **date_kwargs)
+    finally:
+        flush_totals("date", date=date)
+
+# Fingerprint of all inputs of a date, which changes whenever an input is added, replaced or removed
+def date_signature(files):
+    return inputs_signature({os.path.abspath(tif): input_fingerprint(tif) for tif in files})
+
+# The same fingerprint from {absolute path: input fingerprint}, e.g. the inputs recorded in the manifest
+def inputs_signature(fingerprints):
+    digest = hashlib.sha256()
+    for tif in sorted(fingerprints):
+        digest.update(f"{tif}:{fingerprints[tif]}".encode())
+    return digest.hexdigest()
+
+# The record of the last node that finished a date, or None without a claim folder
+def date_record(claims, date):
+    return work_record(claims, f"mosaic_{date}") if claims is not None else None
+
+# Claim a date for this node; without a claim folder every date belongs to this node. A date another node has
+# already mosaicked from the same inputs and settings is released again, otherwise it is mosaicked again
+def claim_date(claims, date, signature, params, output_folder):
+    if claims is None:
+        return True
+    key = f"mosaic_{date}"
+    if not claim_work(claims, key):
+        print(f"Date {date} is claimed by another node, skipping it")
+        return False
+    record = work_record(claims, key)
+    output_exists = os.path.exists(os.path.join(output_folder, f"{date}.tif"))
+    if record is not None and record["inputs"] == signature and record.get("params") == params and output_exists:
+        release_work(claims, key)
+        print(f"Date {date} was already mosaicked from the same inputs and settings, skipping it")
+        return False
+    return True
+
+# Give up the claim of a date; a finished date records the signature of its inputs and its settings for the other
+# nodes
+def release_date(claims, date, signature=None, params=None):
+    if claims is None:
+        return
+    if signature is None:
+        release_work(claims, f"mosaic_{date}")
+    else:
+        finish_work(claims, f"mosaic_{date}", {"inputs": signature, "params": params})
+
+# Combine TIF files based on their dates and coordinates; returns the dates that failed
+def combine_tifs(
+    tif_files, temp_folder, output_folder, *, block_size=10, nodata_value=0, epsg="EPSG:32633", output_profile="lzw",
+    tile_size=512, engine="vrt", partition_size=4096, mosaic_workers=None, date_workers=1, gdal_cache_mb=None,
+    composite="last", red_band=3, nir_band=7, manifest_path=None, incremental=False, aoi=None, claim_folder=None,
+    lease_seconds=300, cube=None, ordering=None,
+):
     date_index = {}
     for tif in tif_files:
         date = date_parser(tif)
@@ -78,43 +776,191 @@ def combine_tifs(tif_files, temp_folder, output_folder, block_size=10, nodata_va
             date_index[date] = []
         date_index[date].append(tif)
 
-    for date, files in date_index.items():
-        print(f"Processing date: {date}")
-        print(f"Number of images to merge: {len(files)}")
+    mosaic_params = get_mosaic_params(
+        nodata_value, epsg, output_profile, tile_size, composite, red_band, nir_band, aoi, ordering
+    )
+    # Arguments passed to process_date for every date, in either mode
+    date_kwargs = {
+        "temp_folder": temp_folder,
+        "output_folder": output_folder,
+        "block_size": block_size,
+        "nodata_value": nodata_value,
+        "epsg": epsg,
+        "output_profile": output_profile,
+        "tile_size": tile_size,
+        "engine": engine,
+        "partition_size": partition_size,
+        "mosaic_workers": mosaic_workers,
+        "composite": composite,
+        "red_band": red_band,
+        "nir_band": nir_band,
+        "manifest_path": manifest_path,
+        "incremental": incremental,
+        "aoi": aoi,
+        "cube": cube,
+        "mosaic_params": mosaic_params,
+    }
 
-        transformed_files = check_and_transform_crs(files, temp_folder, epsg, nodata_value)
+    # Several nodes sharing the input folder claim every date before mosaicking it; finished dates are recorded in
+    # the claim folder with the signature of their inputs
+    claims = start_claims(claim_folder, lease_seconds) if claim_folder else None
+    signatures = {date: date_signature(files) for date, files in date_index.items()} if claims else {}
+    # A failed date is reported and the others are still mosaicked, in either mode; the failures are summarised
+    failed_dates = []
+    try:
+        if date_workers <= 1:
+            if gdal_cache_mb:
+                gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
+            for date, files in date_index.items():
+                if not claim_date(claims, date, signatures.get(date), mosaic_params, output_folder):
+                    continue
+                try:
+                    run_date(date, files, dict(date_kwargs, last_record=date_record(claims, date)))
+                except Exception as e:
+                    print(f"Failed to process date {date}: {e}")
+                    failed_dates.append(date)
+                    release_date(claims, date)
+                    continue
+                release_date(claims, date, signatures.get(date), mosaic_params)
+            return failed_dates
 
-        if len(transformed_files) <= block_size:
-            final_output_file = os.path.join(temp_folder, f"{date}.tif")
-            gdal_warp_merge(transformed_files, final_output_file, nodata_value)
-            print(f"Saved combined TIF for date: {date}")
-        else:
-            blocks = [transformed_files[i:i + block_size] for i in range(0, len(transformed_files), block_size)]
-            block_mosaics = []
+        # Several dates at once, each worker process with its share of the CPU threads and of the GDAL cache
+        threads = max(1, (os.cpu_count() or 1) // date_workers)
+        cache_mb = gdal_cache_mb // date_workers if gdal_cache_mb else None
+        cache_text = f", {cache_mb} MB GDAL cache per worker" if cache_mb else ""
+        print(f"Processing {len(date_index)} dates with {date_workers} workers, {threads} threads each{cache_text}")
+        worker_kwargs = dict(date_kwargs, mosaic_workers=mosaic_workers or threads)
+        pending = list(date_index.items())
+        executor = ProcessPoolExecutor(
+            max_workers=date_workers, initializer=init_date_worker, initargs=(threads, cache_mb)
+        )
+        with executor, tqdm(total=len(pending), desc="Processing dates") as progress:
+            futures = {}
+            # Dates are claimed only when a worker is free, so idle nodes can pick up the remaining ones
+            while pending or futures:
+                while pending and len(futures) < date_workers:
+                    date, files = pending.pop(0)
+                    if not claim_date(claims, date, signatures.get(date), mosaic_params, output_folder):
+                        progress.update(1)
+                        continue
+                    kwargs = dict(worker_kwargs, last_record=date_record(claims, date))
+                    futures[executor.submit(run_date, date, files, kwargs)] = date
+                if not futures:
+                    break
+                gauge("dates_running", len(futures))
+                gauge("dates_pending", len(pending))
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    date = futures.pop(future)
+                    progress.update(1)
+                    try:
+                        future.result()
+                        release_date(claims, date, signatures.get(date), mosaic_params)
+                    except Exception as e:
+                        print(f"Failed to process date {date}: {e}")
+                        failed_dates.append(date)
+                        release_date(claims, date)
+        return failed_dates
+    finally:
+        if failed_dates:
+            print(f"{len(failed_dates)} dates failed: {', '.join(sorted(failed_dates))}")
+        if claims is not None:
+            stop_claims(claims)
 
-            for block_num, block in enumerate(tqdm(blocks, desc="Processing blocks")):
-                block_mosaics.append(process_block(block, date, temp_folder, block_num, nodata_value))
+# Mosaic all files of one date and move the mosaic to the output folder
+def process_date(
+    date, files, *, temp_folder, output_folder, block_size=10, nodata_value=0, epsg="EPSG:32633", output_profile="lzw",
+    tile_size=512, engine="vrt", partition_size=4096, mosaic_workers=None, composite="last", red_band=3, nir_band=7,
+    manifest_path=None, incremental=False, aoi=None, cube=None, mosaic_params=None, last_record=None,
+):
+    print(f"Processing date: {date}")
+    print(f"Number of images to merge: {len(files)}")
 
-            final_output_file = os.path.join(temp_folder, f"{date}.tif")
-            gdal_warp_merge(block_mosaics, final_output_file, nodata_value)
-            print(f"Saved combined TIF for date: {date}")
+    date_start = time.perf_counter()
+    final_output_file = os.path.join(temp_folder, f"{date}.tif")
+    # The copy engine copies or transforms every input into the temp folder before merging
+    copied_bytes = sum(os.path.getsize(tif) for tif in files)
 
-            # Delete temporary block files
-            for block_file in block_mosaics:
-                os.remove(block_file)
+    if engine == "vrt":
+        output_file = os.path.join(output_folder, f"{date}.tif")
+        fingerprints = [input_fingerprint(tif) for tif in files]
+        # COG outputs cannot be updated in place without breaking their layout, so they are always rebuilt
+        if incremental and os.path.exists(output_file) and output_driver(output_profile) != "COG":
+            previous_inputs = load_mosaic_inputs(manifest_path, date)
+            if previous_inputs and load_mosaic_params(manifest_path, date) != mosaic_params:
+                # Updating only the changed partitions would mix the previous and the new settings in one output
+                print(f"The settings of the mosaic of {date} changed, rebuilding it")
+                previous_inputs = None
+            recorded = {tif: fingerprint for tif, (fingerprint, _) in (previous_inputs or {}).items()}
+            if previous_inputs and last_record is not None and (
+                last_record["inputs"] != inputs_signature(recorded) or last_record.get("params") != mosaic_params
+            ):
+                # The manifest is local to this node; another node wrote the mosaic since, from inputs it does not
+                # know, so the changed partitions cannot be told
+                print(f"The mosaic of {date} was last written by another node, rebuilding it")
+                previous_inputs = None
+            if previous_inputs:
+                with span("mosaic", date=date, inputs=len(files), mode="incremental"):
+                    footprints = update_mosaic(
+                        files, fingerprints, previous_inputs, output_file, epsg=epsg, nodata_value=nodata_value,
+                        tile_size=tile_size, partition_size=partition_size, mosaic_workers=mosaic_workers,
+                        composite=composite, red_band=red_band, nir_band=nir_band, aoi=aoi,
+                    )
+                if footprints is not None:
+                    save_mosaic_inputs(
+                        manifest_path, date, mosaic_inputs(files, fingerprints, footprints), mosaic_params
+                    )
+                    if cube is not None:
+                        with span("cube", date=date):
+                            write_to_cube(cube, output_file, date)
+                    print(f"Updated combined TIF for date: {date} in {time.perf_counter() - date_start:.2f} s")
+                    files.clear()
+                    return
 
-            block_mosaics.clear()
-            psutil.virtual_memory()
+        write_start = time.perf_counter()
+        with span("mosaic", date=date, inputs=len(files), mode="vrt"):
+            footprints = vrt_mosaic(
+                files, final_output_file, epsg=epsg, nodata_value=nodata_value, output_profile=output_profile,
+                tile_size=tile_size, partition_size=partition_size, mosaic_workers=mosaic_workers,
+                composite=composite, red_band=red_band, nir_band=nir_band, aoi=aoi,
+            )
+        if footprints is None:
+            print(f"No input of date {date} intersects the AOI, skipping it")
+            files.clear()
+            return
+        write_seconds = time.perf_counter() - write_start
+        report_output(final_output_file, output_profile, write_seconds, time_output_reads(final_output_file, tile_size))
+        temp_bytes = os.path.getsize(final_output_file)
+        print(f"Saved combined TIF for date: {date}")
+        print(
+            f"VRT mosaic: {time.perf_counter() - date_start:.2f} s, {temp_bytes / (1024 * 1024):.1f} MB written to the "
+            f"temp folder, {copied_bytes / (1024 * 1024):.1f} MB of input copies avoided"
+        )
+    else:
+        with span("mosaic", date=date, inputs=len(files), mode="copy"):
+            temp_bytes = copy_mosaic(
+                files, date, temp_folder, final_output_file, block_size=block_size, nodata_value=nodata_value,
+                epsg=epsg, output_profile=output_profile, tile_size=tile_size, transform_workers=mosaic_workers,
+            )
+        print(f"Saved combined TIF for date: {date}")
+        temp_mb = temp_bytes / (1024 * 1024)
+        print(f"Copy mosaic: {time.perf_counter() - date_start:.2f} s, {temp_mb:.1f} MB written to the temp folder")
 
-        # Move the final output file to the output folder
-        shutil.move(final_output_file, os.path.join(output_folder, f"{date}.tif"))
+    if cube is not None:
+        # Written by the date worker itself, so several dates are appended to the cube concurrently
+        with span("cube", date=date):
+            write_to_cube(cube, final_output_file, date)
 
-        # Delete temporary transformed files
-        for transformed_file in transformed_files:
-            os.remove(transformed_file)
+    # Move the final output file to the output folder
+    with span("move", date=date) as record:
+        record["bytes"] = os.path.getsize(final_output_file)
+        shutil.move(final_output_file, os.path.join(output_folder, f"{date}.tif"))
+    if engine == "vrt" and manifest_path:
+        # Remember the inputs of the mosaic, so later runs with --incremental only rewrite what changed
+        save_mosaic_inputs(manifest_path, date, mosaic_inputs(files, fingerprints, footprints), mosaic_params)
 
-        files.clear()
-        psutil.virtual_memory()
+    files.clear()
+    psutil.virtual_memory()
 
 def main():
     parser = argparse.ArgumentParser(description="Combine TIF files based on their coordinates.")
@@ -124,16 +970,183 @@ def main():
     parser.add_argument("--block_size", type=int, default=10, help="Number of files to process in each block")
     parser.add_argument("--nodata_value", type=int, default=0, help="Value to use for nodata pixels")
     parser.add_argument("--epsg", type=str, default="EPSG:32633", help="EPSG code for the coordinate system")
+    parser.add_argument(
+        "--output_profile", type=str, default="lzw", choices=list(OUTPUT_PROFILES),
+        help="Output profile: compression, tiling and COG layout of the mosaics",
+    )
+    parser.add_argument("--tile_size", type=int, default=512, help="Tile size of tiled and COG outputs in pixels")
+    parser.add_argument(
+        "--partition_size", type=int, default=4096,
+        help="Edge length in pixels of the output partitions the vrt engine mosaics in parallel",
+    )
+    parser.add_argument(
+        "--mosaic_workers", type=int,
+        help="Number of partitions mosaicked in parallel by the vrt engine (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--date_workers", type=int, default=1,
+        help="Number of dates mosaicked concurrently in separate processes; the CPU threads and the GDAL cache are "
+        "split between them",
+    )
+    parser.add_argument(
+        "--gdal_cache_mb", type=int,
+        help="Total GDAL block cache in MB, split between the date workers",
+    )
+    parser.add_argument(
+        "--composite", type=str, default="last", choices=["last", "first", "min", "max", "mean", "median", "max_ndvi"],
+        help="How overlapping valid pixels are combined by the vrt engine (default: last, the last input wins)",
+    )
+    parser.add_argument(
+        "--red_band", type=int, default=3,
+        help="Red band index for --composite max_ndvi (default: 3, B04 in the band order of resampling.py)",
+    )
+    parser.add_argument(
+        "--nir_band", type=int, default=7,
+        help="Near infrared band index for --composite max_ndvi (default: 7, B08 in the band order of "
+        "resampling.py)",
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Update existing mosaics in place, rewriting only the partitions that intersect added, replaced or "
+        "removed inputs (vrt engine, not for COG profiles); mosaics whose settings changed since they were "
+        "written are rebuilt",
+    )
+    parser.add_argument(
+        "--manifest", type=str,
+        help=f"SQLite manifest of the inputs of every mosaic (default: {MOSAIC_MANIFEST_NAME} in the output folder)",
+    )
+    parser.add_argument(
+        "--scene_manifest", type=str,
+        help="Manifest of resampling.py with the valid pixel fractions of the scenes measured with --scl_mask; "
+        f"inputs are ordered so the clearest scene is on top (default: {MANIFEST_NAME} in the input folder, if "
+        "present)",
+    )
+    parser.add_argument(
+        "--min_valid_fraction", type=float, default=0.0,
+        help="Skip inputs whose valid pixel fraction in the scene manifest is below this value (0-1)",
+    )
+    parser.add_argument(
+        "--aoi", type=str,
+        help="GeoJSON or other vector file with the area of interest; mosaics are cropped to it, pixels outside "
+        "its polygons are set to nodata and inputs outside it are skipped (vrt engine)",
+    )
+    parser.add_argument(
+        "--claim_folder", type=str,
+        help="Shared folder for lease files; every date is claimed before it is mosaicked, so the same command can "
+        "run on several nodes mounting the same storage; requires a node-local --manifest",
+    )
+    parser.add_argument(
+        "--lease_seconds", type=int, default=300,
+        help="Claims not renewed within this time are taken over from dead nodes",
+    )
+    parser.add_argument(
+        "--cube", type=str,
+        help="Zarr data cube (time, band, y, x) every mosaic is additionally written into; requires zarr",
+    )
+    parser.add_argument(
+        "--cube_bounds", type=float, nargs=4, metavar=("MINX", "MINY", "MAXX", "MAXY"),
+        help="Extent of the data cube in the target crs; the mosaics have to be aligned with its grid",
+    )
+    parser.add_argument(
+        "--cube_chunk_size", type=int, default=256,
+        help="Edge length of the spatial chunks of the data cube in pixels",
+    )
+    parser.add_argument(
+        "--cube_time_chunk", type=int, default=1,
+        help="Number of dates per chunk of the data cube; larger values speed up time series reads, while date "
+        "workers writing into the same chunk wait for each other",
+    )
+    parser.add_argument(
+        "--cube_compression", type=str, default="zstd", choices=CUBE_COMPRESSIONS,
+        help="Compression of the data cube chunks",
+    )
+    parser.add_argument(
+        "--metrics", type=str,
+        help="JSON lines file for timed spans per date and stage, accumulated read, composite and write times of "
+        "the partitions, queue depths and resource samples of all processes; a summary is printed at the end",
+    )
+    parser.add_argument(
+        "--prometheus", type=str,
+        help="Prometheus textfile the summary of the run is written to (e.g. for the node exporter)",
+    )
+    parser.add_argument(
+        "--monitor", action="store_true",
+        help="Sample CPU and memory usage every second, into --metrics if given",
+    )
+    parser.add_argument(
+        "--engine", type=str, default="vrt", choices=["vrt", "copy"],
+        help="vrt: mosaic in process through VRTs without copying the inputs; copy: copy every input to the temp "
+        "folder and merge blocks of block_size files",
+    )
 
     args = parser.parse_args()
+    if args.composite != "last" and args.engine != "vrt":
+        parser.error("--composite requires --engine vrt")
+    if args.incremental and args.engine != "vrt":
+        parser.error("--incremental requires --engine vrt")
+    if args.aoi and args.engine != "vrt":
+        parser.error("--aoi requires --engine vrt")
+    if args.cube and not args.cube_bounds:
+        parser.error("--cube requires --cube_bounds")
+    cube = None
+    if args.cube:
+        cube = cube_settings(
+            args.cube, args.cube_bounds, args.cube_chunk_size, args.cube_time_chunk, args.cube_compression
+        )
+    if args.claim_folder and not args.manifest:
+        parser.error("--claim_folder requires a node-local --manifest; SQLite is not shared between nodes")
+    manifest_path = args.manifest or os.path.join(args.output_folder, MOSAIC_MANIFEST_NAME)
+
+    configure_metrics(args.metrics, args.prometheus)
+    stop_event = Event()
+    if args.monitor:
+        monitor_thread = Thread(target=monitor_resources, args=(stop_event,), daemon=False)
+        monitor_thread.start()
 
     start_time = time.time()
 
     tif_files = list_extension(args.input_folder, "tif")
-    combine_tifs(tif_files, args.temp_folder, args.output_folder, args.block_size, args.nodata_value, args.epsg)
+    scene_manifest = args.scene_manifest or os.path.join(args.input_folder, MANIFEST_NAME)
+    ordering = None
+    if os.path.exists(scene_manifest):
+        valid_fractions = load_valid_fractions(scene_manifest)
+        tif_files = order_by_valid_fraction(tif_files, valid_fractions, args.min_valid_fraction, args.composite)
+        ordering = {"valid_fraction": True, "min_valid_fraction": args.min_valid_fraction}
+    elif args.min_valid_fraction > 0:
+        parser.error(f"--min_valid_fraction requires the scene manifest {scene_manifest}")
+    combine_tifs(
+        tif_files,
+        args.temp_folder,
+        args.output_folder,
+        block_size=args.block_size,
+        nodata_value=args.nodata_value,
+        epsg=args.epsg,
+        output_profile=args.output_profile,
+        tile_size=args.tile_size,
+        engine=args.engine,
+        partition_size=args.partition_size,
+        mosaic_workers=args.mosaic_workers,
+        date_workers=args.date_workers,
+        gdal_cache_mb=args.gdal_cache_mb,
+        composite=args.composite,
+        red_band=args.red_band,
+        nir_band=args.nir_band,
+        manifest_path=manifest_path,
+        incremental=args.incremental,
+        aoi=load_aoi(args.aoi) if args.aoi else None,
+        claim_folder=args.claim_folder,
+        lease_seconds=args.lease_seconds,
+        cube=cube,
+        ordering=ordering,
+    )
 
     end_time = time.time()
     print(f"Processing completed in {end_time - start_time:.2f} seconds")
 
+    if args.monitor:
+        stop_event.set()
+        monitor_thread.join()
+    report_metrics("mosaic", args.prometheus)
+
 if __name__ == "__main__":
     main()
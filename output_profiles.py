@@ -0,0 +1,80 @@
+# output profiles (driver, compression, tiling, overviews) shared by resampling.py and mosaic_tifs.py
+
+import os
+import time
+import numpy as np
+
+OUTPUT_PROFILES = {
+    # Uncompressed GeoTIFF, the historic output of resampling.py
+    "none": {"driver": "GTiff", "compress": None},
+    # LZW-compressed BigTIFF, the historic output of mosaic_tifs.py
+    "lzw": {"driver": "GTiff", "compress": "LZW", "bigtiff": "YES"},
+    "deflate": {"driver": "GTiff", "compress": "DEFLATE", "predictor": True, "tiled": True},
+    "zstd": {"driver": "GTiff", "compress": "ZSTD", "predictor": True, "tiled": True},
+    # Cloud-Optimized GeoTIFFs with internal overviews
+    "cog-deflate": {"driver": "COG", "compress": "DEFLATE", "predictor": True, "overviews": True},
+    "cog-zstd": {"driver": "COG", "compress": "ZSTD", "predictor": True, "overviews": True},
+}
+
+
+def output_driver(profile_name):
+    return OUTPUT_PROFILES[profile_name]["driver"]
+
+
+# GDAL creation options of a profile for a raster of the given data type
+def creation_options(profile_name, dtype, block_size=512, bigtiff=None):
+    profile = OUTPUT_PROFILES[profile_name]
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    options = {}
+
+    if profile["driver"] == "COG":
+        options["BLOCKSIZE"] = str(block_size)
+        options["OVERVIEWS"] = "AUTO" if profile.get("overviews") else "NONE"
+        options["OVERVIEW_RESAMPLING"] = "AVERAGE"
+    elif profile.get("tiled"):
+        options["TILED"] = "YES"
+        options["BLOCKXSIZE"] = str(block_size)
+        options["BLOCKYSIZE"] = str(block_size)
+
+    if profile["compress"]:
+        options["COMPRESS"] = profile["compress"]
+        if profile.get("predictor"):
+            # The COG driver picks the predictor itself, GTiff needs 2 (integers) or 3 (floats)
+            if profile["driver"] == "COG":
+                options["PREDICTOR"] = "YES"
+            else:
+                options["PREDICTOR"] = "3" if floating else "2"
+
+    options["BIGTIFF"] = bigtiff or profile.get("bigtiff", "IF_SAFER")
+    return options
+
+
+# Creation options as the KEY=VALUE list expected by gdalwarp -co and the osgeo.gdal API
+def gdal_option_list(options):
+    return [f"{key}={value}" for key, value in options.items()]
+
+
+# Average time to read a few tile-sized windows, approximating what a tile server sees
+def time_window_reads(read_window, width, height, window_size=512):
+    window_width = min(window_size, width)
+    window_height = min(window_size, height)
+    offsets = [
+        (0, 0),
+        ((width - window_width) // 2, (height - window_height) // 2),
+        (width - window_width, height - window_height),
+    ]
+    start = time.perf_counter()
+    for col_off, row_off in offsets:
+        read_window(col_off, row_off, window_width, window_height)
+    return (time.perf_counter() - start) / len(offsets)
+
+
+# Size, write and window read time of an output for the report of the calling script, in its own language
+def output_report(output_path, profile_name, write_seconds, read_seconds):
+    return {
+        "profile": profile_name,
+        "size_mb": os.path.getsize(output_path) / (1024 * 1024),
+        "write_seconds": write_seconds,
+        "read_ms": read_seconds * 1000,
+        "name": os.path.basename(output_path),
+    }
@@ -0,0 +1,122 @@
+# staging the input files of upcoming scenes from slow storage into a local cache in a background thread, so
+# reading the next scenes overlaps with decoding and resampling the current one
+
+import os
+import queue
+import shutil
+import time
+from threading import Thread, Event, Lock
+from instrumentation import gauge, span
+
+
+def stage_files(folder, paths, target_folder):
+    staged = {}
+    for path in paths:
+        target_path = os.path.join(target_folder, os.path.relpath(path, folder))
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # A file only appears under its name once it is complete
+        shutil.copyfile(path, f"{target_path}.part")
+        os.replace(f"{target_path}.part", target_path)
+        staged[path] = target_path
+    return staged
+
+
+def prefetch_worker(state):
+    while True:
+        item = state["queue"].get()
+        if item is None:
+            break
+        folder, entry = item
+        if entry["evicted"]:
+            continue
+        start = time.perf_counter()
+        try:
+            with span("prefetch", scene=os.path.basename(folder)) as record:
+                staged = stage_files(folder, entry["paths"], entry["target"])
+                record["bytes"] = sum(os.path.getsize(path) for path in staged.values())
+            with state["lock"]:
+                state["staged_files"] += len(staged)
+                state["staged_bytes"] += sum(os.path.getsize(path) for path in staged.values())
+                state["stage_seconds"] += time.perf_counter() - start
+        except Exception as e:
+            # The scene is then read from its original location
+            print(f"Bereitstellen von {folder} fehlgeschlagen: {e}")
+            shutil.rmtree(entry["target"], ignore_errors=True)
+            staged = {}
+        with state["lock"]:
+            entry["staged"] = staged
+            entry["event"].set()
+            evicted = entry["evicted"]
+        if evicted:
+            shutil.rmtree(entry["target"], ignore_errors=True)
+
+
+def start_prefetch(cache_folder):
+    os.makedirs(cache_folder, exist_ok=True)
+    state = {
+        "cache_folder": cache_folder,
+        "queue": queue.Queue(),
+        "scenes": {},
+        "lock": Lock(),
+        "staged_files": 0,
+        "staged_bytes": 0,
+        "stage_seconds": 0.0,
+        "wait_seconds": 0.0,
+        "start_time": time.time(),
+    }
+    state["thread"] = Thread(target=prefetch_worker, args=(state,), daemon=False)
+    state["thread"].start()
+    return state
+
+
+# Queue the files of a scene for staging; scenes are staged one after another in the order they are queued
+def prefetch_scene(state, folder, paths):
+    with state["lock"]:
+        if folder in state["scenes"]:
+            return
+        entry = {
+            "paths": paths,
+            "target": os.path.join(state["cache_folder"], os.path.basename(folder)),
+            "staged": None,
+            "event": Event(),
+            "evicted": False,
+        }
+        state["scenes"][folder] = entry
+    state["queue"].put((folder, entry))
+    gauge("prefetch_queue", state["queue"].qsize())
+
+
+# The cached copies of the given files, waiting until the scene is staged; files that could not be staged are
+# returned unchanged
+def staged_paths(state, folder, paths):
+    prefetch_scene(state, folder, paths)
+    entry = state["scenes"][folder]
+    start = time.perf_counter()
+    entry["event"].wait()
+    with state["lock"]:
+        state["wait_seconds"] += time.perf_counter() - start
+    return [entry["staged"].get(path, path) for path in paths]
+
+
+# Remove the cached copies of a scene once its output is written, or drop it from the queue if not staged yet
+def evict_scene(state, folder):
+    with state["lock"]:
+        entry = state["scenes"].pop(folder, None)
+        if entry is None:
+            return
+        entry["evicted"] = True
+        staged = entry["event"].is_set()
+    if staged:
+        shutil.rmtree(entry["target"], ignore_errors=True)
+
+
+def stop_prefetch(state):
+    for folder in list(state["scenes"]):
+        evict_scene(state, folder)
+    state["queue"].put(None)
+    state["thread"].join()
+    print(
+        f"{state['staged_files']} Dateien ({state['staged_bytes'] / (1024 * 1024):.1f} MB) in "
+        f"{state['stage_seconds']:.2f} Sekunden bereitgestellt; die Verarbeitung hat {state['wait_seconds']:.2f} "
+        "Sekunden auf die Bereitstellung gewartet."
+    )
@@ -2,84 +2,282 @@
 
 import os
 import re
+import json
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+
+# The product patterns: every pattern matches the end of a file name, its groups fill the fields of the
+# template in order. Add new products here.
+PRODUCT_PATTERNS = [
+    {
+        "name": "s1a_grdh",
+        "pattern": r"S1A_IW_GRDH.*_(\d{8})T\d{6}_\d{8}T\d{6}_\d{6}_\w{6}_\w{4}_Cal_Spk_dB_TC\.tif$",
+        "fields": ["date"],
+        "template": "{date}_S1A_IW_GRDH.tif",
+    },
+    {
+        "name": "s2_l2a",
+        "pattern": r"(S2[AB])_MSIL2A.*_(\d{8})T\d{6}_N\d{4}_R\d{3}_T\w{5}_\d{8}T\d{6}\.SAFE_B(\d{2}A?|8A)\.tif$",
+        "fields": ["satellite", "date", "band"],
+        "template": "{date}_{satellite}_MSIL2A_B{band}.tif",
+    },
+    {
+        "name": "s1b_grdh_subset",
+        "pattern": r"Subset_S1B_IW_GRDH_1SDV_(\d{8})T\d{6}_\d{8}T\d{6}_\d{6}_\w{6}_\w{4}_Cal_Spk_dB_TC\.tif$",
+        "fields": ["date"],
+        "template": "{date}_S1A_IW_GRDH.tif",
+    },
+    {
+        "name": "s1b_grdh",
+        "pattern": r"(\d{8})_S1B_IW_GRDH_1SDV\.tif$",
+        "fields": ["date"],
+        "template": "{date}_S1B_IW_GRDH.tif",
+    },
+]
+JOURNAL_NAME = ".rename_journal.jsonl"
+
+
+# All patterns compiled into one alternation, so a file name is scanned once; the named group of every
+# alternative tells which product matched and where its own groups start
+def compile_patterns(patterns):
+    alternatives = []
+    products = {}
+    group_index = 1
+    for product in patterns:
+        pattern = re.compile(product["pattern"])
+        alternatives.append(f"(?P<{product['name']}>{product['pattern']})")
+        products[product["name"]] = (group_index + 1, product)
+        group_index += 1 + pattern.groups
+    return re.compile("|".join(alternatives)), products
+
+
+MATCHER, PRODUCTS = compile_patterns(PRODUCT_PATTERNS)
 
 
 def parse_filename(filename):
-    if "S1A_IW_GRDH" in filename:
-        match = re.search(
-            r"_(\d{8})T\d{6}_\d{8}T\d{6}_\d{6}_\w{6}_\w{4}_Cal_Spk_dB_TC\.tif$",
-            filename,
-        )
-        if match:
-            date = match.group(1)
-            return f"{date}_S1A_IW_GRDH.tif"
-    elif "S2A_MSIL2A" in filename or "S2B_MSIL2A" in filename:
-        match = re.search(
-            r"_(\d{8})T\d{6}_N\d{4}_R\d{3}_T\w{5}_\d{8}T\d{6}\.SAFE_B(\d{2}[A]?)\.tif$",
-            filename,
-        )
-        if match:
-            date = match.group(1)
-            band = match.group(2)
-            satellite = "S2A" if "S2A_MSIL2A" in filename else "S2B"
-            return f"{date}_{satellite}_MSIL2A_B{band}.tif"
-    elif "Subset_S1B_IW_GRDH_1SDV" in filename:
-        match = re.search(
-            r"Subset_S1B_IW_GRDH_1SDV_(\d{8})T\d{6}_\d{8}T\d{6}_\d{6}_\w{6}_\w{4}_Cal_Spk_dB_TC\.tif$",
-            filename,
-        )
-        if match:
-            date = match.group(1)
-            return f"{date}_S1A_IW_GRDH.tif"
-    elif "S1B_IW_GRDH_1SDV" in filename:
-        match = re.search(r"(\d{8})_S1B_IW_GRDH_1SDV\.tif$", filename)
-        if match:
-            date = match.group(1)
-            return f"{date}_S1B_IW_GRDH.tif"
-    elif re.match(
-        r"S2A_MSIL2A_\d{8}T\d{6}_N\d{4}_R\d{3}_T\w{5}_\d{8}T\d{6}\.SAFE_B\d{2}[A]?\.tif$",
-        filename,
-    ):
-        match = re.search(
-            r"S2A_MSIL2A_(\d{8})T\d{6}_N\d{4}_R\d{3}_T\w{5}_(\d{8})T\d{6}\.SAFE_B(\d{2}[A]?)\.tif$",
-            filename,
-        )
-        if match:
-            date = match.group(1)
-            band = match.group(3)
-            return f"{date}_S2A_MSIL2A_B{band}.tif"
-    elif re.match(
-        r"S2A_MSIL2A_\d{8}T\d{6}_N\d{4}_R\d{3}_T\w{5}_\d{8}T\d{6}\.SAFE_B8A\.tif$",
-        filename,
-    ):
-        match = re.search(
-            r"S2A_MSIL2A_(\d{8})T\d{6}_N\d{4}_R\d{3}_T\w{5}_(\d{8})T\d{6}\.SAFE_B8A\.tif$",
-            filename,
-        )
-        if match:
-            date = match.group(1)
-            return f"{date}_S2A_MSIL2A_B8A.tif"
-    return None
+    if not filename.endswith(".tif"):
+        return None
+    match = MATCHER.search(filename)
+    if not match:
+        return None
+    first_group, product = PRODUCTS[match.lastgroup]
+    values = match.groups()[first_group - 1 : first_group - 1 + len(product["fields"])]
+    return product["template"].format(**dict(zip(product["fields"], values)))
 
 
-def rename_files_in_directory(directory):
-    existing_filenames = set()
-    for filename in os.listdir(directory):
-        if os.path.isfile(os.path.join(directory, filename)):
+# Directories with their file names, one scandir per directory without a stat per entry
+def scan_directories(directory, recursive=False):
+    pending = [directory]
+    while pending:
+        folder = pending.pop()
+        filenames = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    filenames.append(entry.name)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+        yield folder, filenames
+
+
+# (source, target) pairs of all files to rename, directory by directory. A new name never replaces an existing
+# file or another new name; duplicates get a counter as before
+def plan_renames(directory, recursive=False):
+    for folder, filenames in scan_directories(directory, recursive):
+        taken = set(filenames)
+        for filename in filenames:
             new_filename = parse_filename(filename)
-            if new_filename:
-                original_new_filename = new_filename
-                counter = 1
-                while new_filename in existing_filenames:
-                    new_filename = f"{os.path.splitext(original_new_filename)[0]}_{counter}.tif"
-                    counter += 1
-                existing_filenames.add(new_filename)
-                os.rename(
-                    os.path.join(directory, filename),
-                    os.path.join(directory, new_filename),
-                )
-                print(f"Renamed {filename} to {new_filename}")
+            if not new_filename:
+                continue
+            original_new_filename = new_filename
+            counter = 1
+            while new_filename in taken:
+                new_filename = f"{os.path.splitext(original_new_filename)[0]}_{counter}.tif"
+                counter += 1
+            taken.add(new_filename)
+            yield os.path.join(folder, filename), os.path.join(folder, new_filename)
+
+
+def open_journal(journal_path):
+    return {"file": open(journal_path, "a"), "lock": Lock()}
+
+
+def write_journal(journal, record):
+    if journal is None:
+        return
+    with journal["lock"]:
+        journal["file"].write(json.dumps(record) + "\n")
+        journal["file"].flush()
+
+
+# Planned renames have to be on disk before they happen, otherwise a crash could leave renamed files that no
+# rollback knows about; finished renames may be lost, resume recognises them by their target
+def sync_journal(journal):
+    if journal is None:
+        return
+    with journal["lock"]:
+        os.fsync(journal["file"].fileno())
+
+
+def close_journal(journal, complete):
+    if complete:
+        write_journal(journal, {"op": "complete"})
+    os.fsync(journal["file"].fileno())
+    journal["file"].close()
+
+
+# Directory and options of the run, planned renames, finished sources and whether the run completed, from the
+# journal of an earlier run
+def read_journal(journal_path):
+    run = {}
+    planned = {}
+    done = set()
+    complete = False
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of an interrupted run
+                continue
+            if record["op"] == "start":
+                run = record
+            elif record["op"] == "plan":
+                planned[record["source"]] = record["target"]
+            elif record["op"] == "done":
+                done.add(record["source"])
+            elif record["op"] == "complete":
+                complete = True
+    return {"run": run, "planned": planned, "done": done, "complete": complete}
+
+
+def rename_file(source, target, journal):
+    os.rename(source, target)
+    write_journal(journal, {"op": "done", "source": source})
+    print(f"Renamed {os.path.basename(source)} to {os.path.basename(target)}")
+
+
+def count_renames(futures, count, failed):
+    for future in futures:
+        if future.exception():
+            print(f"Renaming failed: {future.exception()}")
+            failed += 1
+        else:
+            count += 1
+    return count, failed
+
+
+def batches(pairs, size):
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Rename the pairs with a pool of threads; renames on network storage are bound by latency, not CPU. The pairs
+# are journaled and synced in batches before they are renamed, and only a bounded number of renames is queued,
+# so the pairs can be streamed from the planner
+def run_renames(pairs, journal, workers=8, journal_plan=True):
+    count = 0
+    failed = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches(pairs, workers * 32):
+            if journal_plan:
+                for source, target in batch:
+                    write_journal(journal, {"op": "plan", "source": source, "target": target})
+                sync_journal(journal)
+            for source, target in batch:
+                pending.add(executor.submit(rename_file, source, target, journal))
+            while len(pending) >= workers * 64:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                count, failed = count_renames(finished, count, failed)
+        count, failed = count_renames(pending, count, failed)
+    return count, failed
+
+
+def rename_files_in_directory(
+    directory, recursive=False, dry_run=False, workers=8, journal_path=None
+):
+    if dry_run:
+        count = 0
+        for source, target in plan_renames(directory, recursive):
+            print(f"Would rename {source} to {os.path.basename(target)}")
+            count += 1
+        print(f"{count} files would be renamed")
+        return
+    journal_path = journal_path or os.path.join(directory, JOURNAL_NAME)
+    if os.path.exists(journal_path):
+        if not read_journal(journal_path)["complete"]:
+            raise RuntimeError(
+                f"The journal {journal_path} belongs to an interrupted run; "
+                "continue it with --resume or undo it with --rollback"
+            )
+        os.remove(journal_path)
+    journal = open_journal(journal_path)
+    write_journal(
+        journal,
+        {"op": "start", "directory": os.path.abspath(directory), "recursive": recursive},
+    )
+    complete = False
+    try:
+        renamed, failed = run_renames(
+            plan_renames(directory, recursive), journal, workers
+        )
+        complete = failed == 0
+    finally:
+        close_journal(journal, complete)
+    print(f"Renamed {renamed} files, {failed} failed")
+
+
+# Finish the renames of an interrupted run; renames that happened but were not journaled are recognised by the
+# target existing without its source. The run only journaled the part of its plan it reached, so the directory is
+# planned again afterwards; renamed files match no product pattern and are left alone
+def resume_renames(journal_path, workers=8):
+    state = read_journal(journal_path)
+    journal = open_journal(journal_path)
+    pairs = []
+    for source, target in state["planned"].items():
+        if source in state["done"]:
+            continue
+        if os.path.exists(source) and not os.path.exists(target):
+            pairs.append((source, target))
+        elif os.path.exists(target) and not os.path.exists(source):
+            write_journal(journal, {"op": "done", "source": source})
+        else:
+            print(f"Cannot resume the rename of {source}: source or target is missing")
+    complete = False
+    try:
+        renamed, failed = run_renames(pairs, journal, workers, journal_plan=False)
+        if state["run"]:
+            replanned = plan_renames(state["run"]["directory"], state["run"]["recursive"])
+            more_renamed, more_failed = run_renames(replanned, journal, workers)
+            renamed, failed = renamed + more_renamed, failed + more_failed
+        else:
+            print("The journal does not name its directory; only its planned renames were resumed")
+        complete = failed == 0
+    finally:
+        close_journal(journal, complete)
+    print(f"Resumed: renamed {renamed} more files, {failed} failed")
+
+
+# Undo all renames of a journal, completed or interrupted, and remove the journal
+def rollback_renames(journal_path, workers=8):
+    planned = read_journal(journal_path)["planned"]
+    pairs = [
+        (target, source)
+        for source, target in planned.items()
+        if os.path.exists(target) and not os.path.exists(source)
+    ]
+    renamed, failed = run_renames(pairs, None, workers, journal_plan=False)
+    if failed == 0:
+        os.remove(journal_path)
+    print(f"Rolled back {renamed} renames, {failed} failed")
 
 
 if __name__ == "__main__":
@@ -92,7 +290,46 @@ if __name__ == "__main__":
         required=True,
         help="Path to the directory containing the files",
     )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="Rename the files in all subdirectories as well",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only print the planned renames",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of renames in parallel",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        help=f"Journal of the renames for --resume and --rollback (default: {JOURNAL_NAME} in the directory)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Finish the renames of an interrupted run from its journal",
+    )
+    parser.add_argument(
+        "--rollback",
+        action="store_true",
+        help="Undo the renames recorded in the journal",
+    )
 
     args = parser.parse_args()
 
-    rename_files_in_directory(args.directory)
+    journal_path = args.journal or os.path.join(args.directory, JOURNAL_NAME)
+    if args.resume:
+        resume_renames(journal_path, args.workers)
+    elif args.rollback:
+        rollback_renames(journal_path, args.workers)
+    else:
+        rename_files_in_directory(
+            args.directory, args.recursive, args.dry_run, args.workers, args.journal
+        )
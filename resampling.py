@@ -1,51 +1,433 @@
 # resampling all input bands to a common resolution and saving them as a single multiband TIFF file
 
 import os
-import glob
 import argparse
 import rasterio
-from rasterio.warp import reproject, Resampling
+import rasterio.shutil
+from rasterio.warp import reproject, Resampling, transform_geom
+from rasterio.windows import Window, transform as window_transform
+from rasterio.features import geometry_mask
 import earthpy.spatial as es
 import numpy as np
 import psutil
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from threading import Thread, Event, Lock
 import shutil
 import gc
 import re
+import math
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from aoi import geometry_bounds, intersect_bounds, load_aoi
+from instrumentation import configure_metrics, flush_totals, gauge, monitor_resources, report_metrics, span, timed
+from data_cube import CUBE_COMPRESSIONS, cube_settings, write_to_cube
+from background_transfer import (
+    enqueue_transfer,
+    file_checksum,
+    start_transfer_worker,
+    stop_transfer_worker,
+    wait_for_transfer_budget,
+)
+from manifest import (
+    MANIFEST_NAME,
+    encode_params,
+    init_manifest,
+    is_scene_done,
+    load_manifest,
+    load_scene_record,
+    record_moved_output,
+    scene_fingerprint,
+    update_scene,
+)
+from scene_catalog import build_catalog, scan_scene, scene_band_paths
+from output_profiles import OUTPUT_PROFILES, creation_options, output_driver, output_report, time_window_reads
+from prefetch import evict_scene, prefetch_scene, staged_paths, start_prefetch, stop_prefetch
+from work_claims import claim_work, finish_work, release_work, start_claims, stop_claims, work_record
 
+MIN_BLOCK_SIZE = 16
+# Working set of the average, min and max reducers per target pixel: count, accumulator and their temporaries
+REDUCE_BYTES_PER_PIXEL = 40
+# Bytes per source pixel held by the med and mode reducers: the stacked values, validity, and the float64 copies
+# of med (mode holds its counts and flags instead)
+RANK_BYTES_PER_PIXEL = 17
+# GDAL's default warp buffer (GDAL_WARP_MEMORY / -wm) and the baseline RSS of a worker process
+GDAL_WARP_MEMORY = 64 * 1024 * 1024
+PROCESS_OVERHEAD = 200 * 1024 * 1024
+# Resampling methods that reduce to pure array operations between grids that differ by an integer factor
+FAST_PATH_RESAMPLING = (
+    Resampling.nearest,
+    Resampling.average,
+    Resampling.med,
+    Resampling.mode,
+    Resampling.min,
+    Resampling.max,
+)
+# Scene Classification (SCL) classes of L2A products masked by default: no data, saturated or defective,
+# cloud shadows, clouds of medium and high probability and thin cirrus
+SCL_MASK_CLASSES = [0, 1, 3, 8, 9, 10]
+# Messages of the shared claims, in the language of this script
+CLAIM_MESSAGES = {
+    "taken_over": "Verwaisten Claim von {key} übernommen ({age:.0f} s ohne Erneuerung)",
+    "lost": "Der Claim von {key} wurde von einem anderen Knoten übernommen",
+    "renew_failed": "Erneuern des Claims von {key} fehlgeschlagen: {error}",
+}
 
-def resample_band(src, dst, band_index, transform, resolution):
-    if band_index > src.count:
-        raise ValueError(
-            f"Band index {band_index} out of range for dataset with {src.count} bands."
+
+# Bytes held while one output block of the given edge length is resampled from a source
+# that is `scale` times finer (scale = target resolution / source resolution). The block reducers of the fast path
+# add their validity mask of the source, float64 accumulators per target pixel and, for med and mode, strips of at
+# most the size of the source (see reduce_strip_rows)
+def block_footprint(block_size, scale, itemsize):
+    dst_pixels = block_size * block_size
+    src_edge = math.ceil(block_size * scale) + 2
+    src_bytes = src_edge * src_edge * itemsize
+    reduce_bytes = src_edge * src_edge + dst_pixels * REDUCE_BYTES_PER_PIXEL + src_bytes
+    return dst_pixels * itemsize + src_bytes + reduce_bytes
+
+
+# Halve the block edge until one block fits into the half of the worker memory cap that is not left to GDAL's warper
+def fit_block_size(block_size, scale, itemsize, worker_memory_mb):
+    if worker_memory_mb is None:
+        return block_size
+    limit = worker_memory_mb * 1024 * 1024 // 2
+    while block_footprint(block_size, scale, itemsize) > limit:
+        if block_size <= MIN_BLOCK_SIZE:
+            raise ValueError(f"Worker memory cap of {worker_memory_mb} MB is too small for a single block.")
+        block_size = max(MIN_BLOCK_SIZE, block_size // 2)
+    return block_size
+
+
+def plan_block_windows(width, height, block_size):
+    return [
+        Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+        for row_off in range(0, height, block_size)
+        for col_off in range(0, width, block_size)
+    ]
+
+
+# Split an output tile into sub-blocks that are written in order, so the tile is complete before the next one starts
+def split_window(window, block_size):
+    return [
+        Window(
+            window.col_off + col_off,
+            window.row_off + row_off,
+            min(block_size, window.width - col_off),
+            min(block_size, window.height - row_off),
         )
-    reproject(
-        source=rasterio.band(src, band_index),
-        destination=rasterio.band(dst, band_index),
-        src_transform=src.transform,
-        src_crs=src.crs,
-        dst_transform=transform,
-        dst_crs=src.crs,
-        resampling=Resampling.nearest,
-    )
+        for row_off in range(0, window.height, block_size)
+        for col_off in range(0, window.width, block_size)
+    ]
+
+
+# Radius in source pixels of GDAL's resampling kernels; when downsampling, GDAL widens the kernel by the factor
+KERNEL_RADIUS = {
+    Resampling.nearest: 1,
+    Resampling.bilinear: 1,
+    Resampling.cubic: 2,
+    Resampling.cubic_spline: 2,
+    Resampling.lanczos: 3,
+}
+
+
+# Source pixels a block has to read beyond its bounds, so that blocks match a warp of the whole raster
+def kernel_padding(resampling, scale):
+    return math.ceil(KERNEL_RADIUS.get(resampling, 1) * max(1.0, scale)) + 1
+
+
+# Read the part of band 1 that covers the destination bounds, padded by the reach of the resampling kernel
+def read_source_window(src, dst_transform, width, height, padding=1):
+    left, top = dst_transform * (0, 0)
+    right, bottom = dst_transform * (width, height)
+    col_start, row_start = ~src.transform * (left, top)
+    col_stop, row_stop = ~src.transform * (right, bottom)
+    col_off = max(0, math.floor(col_start) - padding)
+    row_off = max(0, math.floor(row_start) - padding)
+    col_end = min(src.width, math.ceil(col_stop) + padding)
+    row_end = min(src.height, math.ceil(row_stop) + padding)
+    if col_end <= col_off or row_end <= row_off:
+        return None, None
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    with timed("decode"):
+        source = src.read(1, window=window)
+    return source, src.window_transform(window)
+
+
+# Return the ratio of two pixel sizes if it is a whole number, else None
+def integer_ratio(larger, smaller):
+    ratio = larger / smaller
+    factor = round(ratio)
+    if factor >= 1 and math.isclose(ratio, factor, rel_tol=1e-9):
+        return factor
+    return None
+
+
+# Check whether source and target grid differ only by an integer scale on a shared pixel lattice
+def plan_fast_path(src, dst_transform, dst_crs, resampling):
+    if resampling not in FAST_PATH_RESAMPLING or src.crs != dst_crs:
+        return None
+    src_transform = src.transform
+    for transform in (src_transform, dst_transform):
+        # Only north-up grids with square pixels
+        if transform.b != 0 or transform.d != 0 or transform.a <= 0 or not math.isclose(transform.a, -transform.e):
+            return None
+
+    upsample = dst_transform.a <= src_transform.a
+    if upsample:
+        factor = integer_ratio(src_transform.a, dst_transform.a)
+        unit = dst_transform.a
+    else:
+        factor = integer_ratio(dst_transform.a, src_transform.a)
+        unit = src_transform.a
+    col_shift = (dst_transform.c - src_transform.c) / unit
+    row_shift = (src_transform.f - dst_transform.f) / unit
+    if factor is None or not math.isclose(col_shift, round(col_shift), abs_tol=1e-6):
+        return None
+    if not math.isclose(row_shift, round(row_shift), abs_tol=1e-6):
+        return None
+    return {"upsample": upsample, "factor": factor, "col_shift": round(col_shift), "row_shift": round(row_shift)}
+
+
+def nodata_mask(values, nodata):
+    if nodata is None:
+        return np.ones(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return ~np.isnan(values)
+    return values != nodata
+
+
+# The factor x factor strided views of an array, one per pixel position inside a block, in row-major order
+def block_slices(array, factor):
+    return [array[i::factor, j::factor] for i in range(factor) for j in range(factor)]
+
+
+# Target rows per strip of the med and mode reducers, so that a strip holds no more than the source block itself
+def reduce_strip_rows(source, factor, width):
+    strip_bytes = width * factor * factor * (source.itemsize + RANK_BYTES_PER_PIXEL)
+    return max(1, source.nbytes // strip_bytes)
+
+
+# Median or mode of the valid values of every block; works on the stacked values, so it is run on strips of rows
+def reduce_ranked(slices, valid_slices, count, resampling):
+    blocks = np.stack(slices, axis=-1)
+    block_valid = np.stack(valid_slices, axis=-1)
+    if resampling == Resampling.med:
+        # Lower median of the valid values
+        values = blocks.astype(np.float64)
+        values[~block_valid] = np.inf
+        values.sort(axis=-1)
+        index = np.maximum(count - 1, 0) // 2
+        return np.take_along_axis(values, index[..., None], axis=-1)[..., 0]
+    # Mode: among the most frequent values GDAL keeps the one that reached its count first,
+    # i.e. the one whose last occurrence comes earliest
+    counts = np.zeros(blocks.shape, dtype=np.int32)
+    is_last = np.zeros(blocks.shape, dtype=bool)
+    for i in range(blocks.shape[-1]):
+        equal = (blocks == blocks[..., i : i + 1]) & block_valid
+        counts[..., i] = np.where(block_valid[..., i], equal.sum(axis=-1), 0)
+        is_last[..., i] = block_valid[..., i] & ~equal[..., i + 1 :].any(axis=-1)
+    winner = (counts == counts.max(axis=-1, keepdims=True)) & is_last
+    index = np.argmax(winner, axis=-1)
+    return np.take_along_axis(blocks, index[..., None], axis=-1)[..., 0]
+
+
+# Reduce every factor x factor block of source pixels to one target pixel the way GDAL's warper does
+def reduce_blocks(source, factor, resampling, nodata, dtype):
+    # Accumulating over strided views is far faster than reducing over the axes of a reshaped block view
+    slices = block_slices(source, factor)
+    valid_slices = block_slices(nodata_mask(source, nodata), factor)
+    count = np.zeros(slices[0].shape, dtype=np.int32)
+    for valid in valid_slices:
+        count += valid
+
+    integer = np.issubdtype(source.dtype, np.integer)
+    if resampling == Resampling.average:
+        total = np.zeros(count.shape, dtype=np.int64 if integer else np.float64)
+        for values, valid in zip(slices, valid_slices):
+            total += np.where(valid, values, 0) if nodata is not None else values
+        result = total / np.maximum(count, 1)
+        if np.issubdtype(dtype, np.integer):
+            # GDAL rounds half up when writing averages to integer bands; exact .5 ties can still
+            # differ by one from GDAL, whose pixel weights carry floating point noise
+            result = np.floor(result + 0.5)
+    elif resampling in (Resampling.min, Resampling.max):
+        if resampling == Resampling.min:
+            reduce, fill = np.minimum, np.iinfo(source.dtype).max if integer else np.inf
+        else:
+            reduce, fill = np.maximum, np.iinfo(source.dtype).min if integer else -np.inf
+        result = np.full(count.shape, fill, dtype=source.dtype)
+        for values, valid in zip(slices, valid_slices):
+            reduce(result, np.where(valid, values, fill) if nodata is not None else values, out=result)
+    else:
+        height, width = count.shape
+        result = np.empty(count.shape, dtype=np.float64 if resampling == Resampling.med else source.dtype)
+        rows = reduce_strip_rows(source, factor, width)
+        for top in range(0, height, rows):
+            strip = slice(top, top + rows)
+            result[strip] = reduce_ranked(
+                [values[strip] for values in slices], [valid[strip] for valid in valid_slices], count[strip], resampling
+            )
+
+    if nodata is not None:
+        result = np.where(count > 0, result, nodata)
+    return result.astype(dtype)
+
+
+# Resample one block with plain array operations; returns None if the block needs source pixels outside the source
+def resample_block_fast(src, window, plan, dtype, resampling):
+    factor = plan["factor"]
+    if plan["upsample"]:
+        # Every target pixel lies inside exactly one source pixel, so all methods reduce to repetition
+        rows = (plan["row_shift"] + window.row_off + np.arange(window.height)) // factor
+        cols = (plan["col_shift"] + window.col_off + np.arange(window.width)) // factor
+        if rows[0] < 0 or cols[0] < 0 or rows[-1] >= src.height or cols[-1] >= src.width:
+            return None
+        with timed("decode"):
+            source = src.read(
+                1, window=Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+            )
+        with timed("warp"):
+            return source.take(rows - rows[0], axis=0).take(cols - cols[0], axis=1).astype(dtype, copy=False)
+
+    row_start = plan["row_shift"] + window.row_off * factor
+    col_start = plan["col_shift"] + window.col_off * factor
+    height, width = window.height * factor, window.width * factor
+    if row_start < 0 or col_start < 0 or row_start + height > src.height or col_start + width > src.width:
+        return None
+    with timed("decode"):
+        source = src.read(1, window=Window(col_start, row_start, width, height))
+    with timed("warp"):
+        if resampling == Resampling.nearest:
+            # The target pixel centre falls on the source pixel at offset factor // 2
+            return source[factor // 2 :: factor, factor // 2 :: factor].astype(dtype, copy=False)
+        return reduce_blocks(source, factor, resampling, src.nodata, dtype)
+
+
+def resample_block(src, window, dst_transform, dst_crs, dtype, resampling=Resampling.nearest, warp_mem_limit=0):
+    block_transform = rasterio.windows.transform(window, dst_transform)
+    data = np.zeros((window.height, window.width), dtype=dtype)
+    if src.nodata is not None:
+        data.fill(src.nodata)
+    scale = abs(block_transform.a) / abs(src.transform.a)
+    padding = kernel_padding(resampling, scale)
+    source, source_transform = read_source_window(src, block_transform, window.width, window.height, padding)
+    if source is None:
+        return data
+    with timed("warp"):
+        reproject(
+            source=source,
+            destination=data,
+            src_transform=source_transform,
+            src_crs=src.crs,
+            src_nodata=src.nodata,
+            dst_transform=block_transform,
+            dst_crs=dst_crs,
+            dst_nodata=src.nodata,
+            resampling=resampling,
+            warp_mem_limit=warp_mem_limit,
+        )
+    return data
+
+
+# Resample band 1 of src into band_index of dst block by block, so that a worker never holds more than one block
+def resample_band(
+    src,
+    dst,
+    band_index,
+    windows,
+    write_lock,
+    worker_memory_mb=None,
+    resampling=Resampling.nearest,
+    aoi_geometries=None,
+    scl_mask=None,
+):
+    # GDAL dataset handles are not thread-safe, so every access to dst is serialised
+    with write_lock:
+        dst_transform, dst_crs = dst.transform, dst.crs
+        dtype = dst.dtypes[band_index - 1]
+        nodata = dst.nodata if dst.nodata is not None else 0
+    scale = abs(dst_transform.a) / abs(src.transform.a)
+    tile_size = max(max(window.width, window.height) for window in windows)
+    block_size = fit_block_size(tile_size, scale, np.dtype(dtype).itemsize, worker_memory_mb)
+    warp_mem_limit = worker_memory_mb // 2 if worker_memory_mb else 0
+    fast_plan = plan_fast_path(src, dst_transform, dst_crs, resampling)
+
+    for window in windows:
+        for block in split_window(window, block_size):
+            outside = None
+            if aoi_geometries:
+                outside = geometry_mask(
+                    aoi_geometries,
+                    out_shape=(block.height, block.width),
+                    transform=window_transform(block, dst_transform),
+                )
+            if scl_mask is not None:
+                masked = scl_block_mask(scl_mask, block, dst_transform)
+                outside = masked if outside is None else outside | masked
+            data = None
+            if outside is not None and outside.all():
+                # Blocks entirely outside the AOI or masked by the SCL are never read from the source
+                data = np.full((block.height, block.width), nodata, dtype=dtype)
+            if data is None and fast_plan is not None:
+                data = resample_block_fast(src, block, fast_plan, dtype, resampling)
+            if data is None:
+                data = resample_block(src, block, dst_transform, dst_crs, dtype, resampling, warp_mem_limit)
+            if outside is not None:
+                data[outside] = nodata
+            with write_lock, timed("write"):
+                dst.write(data, band_index, window=block)
     print(f"Band {band_index} resampled.")
 
 
-def get_unique_filename(output_folder, base_filename):
-    output_path = os.path.join(output_folder, base_filename)
-    if not os.path.exists(output_path):
-        return output_path
+# Reproject a single source band into one band of a shared multiband output
+def resample_band_direct(
+    band_path,
+    dst,
+    band_index,
+    windows,
+    write_lock,
+    resolution,
+    worker_memory_mb,
+    resampling,
+    use_overviews,
+    jp2_threads,
+    aoi_geometries=None,
+    scl_mask=None,
+):
+    with span("band", band=band_index, path=band_path):
+        with open_band(band_path, resolution, use_overviews, jp2_threads) as src:
+            resample_band(
+                src, dst, band_index, windows, write_lock, worker_memory_mb, resampling, aoi_geometries, scl_mask
+            )
 
-    base, ext = os.path.splitext(base_filename)
-    counter = 1
-    while True:
-        new_filename = f"{base}_{counter}{ext}"
-        new_output_path = os.path.join(output_folder, new_filename)
-        if not os.path.exists(new_output_path):
-            return new_output_path
-        counter += 1
+
+# Index of the coarsest overview that is at least as fine as the target and divides it by an integer factor
+def choose_overview_level(native_resolution, overview_factors, resolution):
+    level = None
+    for idx, factor in enumerate(overview_factors):
+        overview_resolution = native_resolution * factor
+        if overview_resolution > resolution * (1 + 1e-9):
+            break
+        if integer_ratio(resolution, overview_resolution) is not None:
+            level = idx
+    return level
+
+
+# Open a band, optionally at a reduced JPEG2000 resolution level that OpenJPEG decodes much faster
+# than the full resolution. rasterio.Env options are thread-local, so every band worker gets its own.
+@contextmanager
+def open_band(band_path, resolution, use_overviews=False, jp2_threads=None):
+    options = {"GDAL_NUM_THREADS": str(jp2_threads)} if jp2_threads else {}
+    with rasterio.Env(**options):
+        open_kwargs = {}
+        if use_overviews:
+            with rasterio.open(band_path) as src:
+                level = choose_overview_level(src.res[0], src.overviews(1), resolution)
+            if level is not None:
+                open_kwargs["overview_level"] = level
+        with rasterio.open(band_path, **open_kwargs) as src:
+            yield src
 
 
 def get_unique_foldername(base_folder, base_foldername):
@@ -62,96 +444,127 @@ def get_unique_foldername(base_folder, base_foldername):
         counter += 1
 
 
-def resample_and_save_band(band_path, temp_path, transform, width, height, resolution):
-    with rasterio.open(band_path) as src:
+# Pixels outside the AOI or masked by the SCL are filled with the nodata value of the output, 0 if the source has
+# none; it has to be declared, or readers take the filled pixels for valid zeros
+def declare_nodata(meta, aoi_geometries, scl_mask):
+    if meta.get("nodata") is None and (aoi_geometries or scl_mask is not None):
+        meta["nodata"] = 0
+
+
+def resample_and_save_band(
+    band_path,
+    temp_path,
+    grid,
+    block_size,
+    worker_memory_mb,
+    resampling,
+    use_overviews,
+    jp2_threads,
+    aoi_geometries=None,
+    scl_mask=None,
+):
+    with span("band", path=band_path), open_band(band_path, grid["transform"].a, use_overviews, jp2_threads) as src:
         kwargs = src.meta.copy()
+        kwargs.update(grid)
         kwargs.update(
             {
-                "crs": src.crs,
-                "transform": transform,
-                "width": width,
-                "height": height,
                 "count": 1,  # Single band
                 "driver": "GTiff",  # Ensure the output is a GeoTIFF
             }
         )
+        kwargs.update(tiled_profile(block_size))
+        declare_nodata(kwargs, aoi_geometries, scl_mask)
 
+        windows = plan_block_windows(grid["width"], grid["height"], block_size)
         with rasterio.open(temp_path, "w", **kwargs) as dst:
-            resample_band(src, dst, 1, transform, resolution)
+            resample_band(src, dst, 1, windows, Lock(), worker_memory_mb, resampling, aoi_geometries, scl_mask)
 
 
 def move_files(temp_output_folder, final_output_folder):
     for file_name in os.listdir(temp_output_folder):
+        # Partial outputs of failed scenes (".part", or ".part.tif" of older versions) stay behind
+        if file_name.endswith((".part", ".part.tif")):
+            continue
         file_path = os.path.join(temp_output_folder, file_name)
         shutil.move(file_path, final_output_folder)
     print(f"Dateien wurden nach {final_output_folder} verschoben.")
 
 
-def list_processed_files(output_folder):
-    processed_files = set()
-    for file_name in os.listdir(output_folder):
-        if file_name.endswith(".tif"):
-            processed_files.add(file_name)
-    return processed_files
-
-
-def delete_processed_folders(base_folder, processed_files):
-    subfolders = [f.path for f in os.scandir(base_folder) if f.is_dir()]
+# Delete the input folders whose scenes the manifest records as finished and return the fingerprints of the others
+def delete_processed_folders(subfolders, catalog, manifest, scene_params, final_output_folder):
+    fingerprints = {}
     for folder in subfolders:
-        folder_name = os.path.basename(folder)
-        date = folder_name[11:19]
-        base_filename = f"{date}_{folder_name}.tif"
-        if base_filename in processed_files:
+        fingerprint = scene_fingerprint(catalog[folder]["files"])
+        if is_scene_done(manifest.get(os.path.basename(folder)), fingerprint, scene_params, final_output_folder):
             print(f"Lösche bereits verarbeiteten Ordner: {folder}")
             shutil.rmtree(folder, ignore_errors=True)
+        else:
+            fingerprints[folder] = fingerprint
+    return fingerprints
 
 
-def resample_and_save_bands(
-    input_folder,
+def tiled_profile(block_size):
+    if block_size % 16:
+        raise ValueError(f"Block size {block_size} must be a multiple of 16 for tiled GeoTIFFs.")
+    return {"tiled": True, "blockxsize": block_size, "blockysize": block_size}
+
+
+# Creation options for the GeoTIFF the workers write into; COG outputs are written as plain tiled GeoTIFF first
+def gtiff_options(output_profile, dtype, block_size):
+    if output_driver(output_profile) != "GTiff":
+        return {}
+    return {key.lower(): value for key, value in creation_options(output_profile, dtype, block_size).items()}
+
+
+# The COG driver can only copy a finished raster, which also lays out the internal overviews
+def convert_to_cog(part_path, output_path, output_profile, block_size):
+    with rasterio.open(part_path) as src:
+        dtype = src.dtypes[0]
+    rasterio.shutil.copy(
+        part_path, output_path, driver="COG", **creation_options(output_profile, dtype, block_size)
+    )
+    os.remove(part_path)
+
+
+# Size, write and window read time of an output
+def report_output(output_path, output_profile, write_seconds, read_seconds):
+    report = output_report(output_path, output_profile, write_seconds, read_seconds)
+    print(
+        f"Ausgabeprofil {report['profile']}: {report['size_mb']:.1f} MB, Schreiben {report['write_seconds']:.2f} s, "
+        f"Fensterlesen {report['read_ms']:.1f} ms ({report['name']})"
+    )
+
+
+def time_output_reads(output_path, block_size):
+    with rasterio.open(output_path) as src:
+        return time_window_reads(
+            lambda col_off, row_off, width, height: src.read(window=Window(col_off, row_off, width, height)),
+            src.width,
+            src.height,
+            block_size,
+        )
+
+
+def write_bands_stacked(
+    band_paths,
+    grid,
     base_folder,
-    temp_output_folder,
-    final_output_folder,
-    bands,
-    resolution,
+    folder_name,
+    output_path,
     max_workers,
-    max_temp_files,
-    processed_files,
+    block_size,
+    worker_memory_mb,
+    resampling,
+    use_overviews,
+    jp2_threads,
+    output_profile,
+    aoi_geometries=None,
+    scl_mask=None,
 ):
-    folder_name = os.path.basename(input_folder)
-    date = folder_name[11:19]
-
-    # Use the date and the rest of the input folder name for the filename
-    base_filename = f"{date}_{folder_name}.tif"
-    if base_filename in processed_files:
-        print(f"Datei {base_filename} wurde bereits verarbeitet. Überspringe...")
-        return
-
     # Create a worker-specific temporary directory within the base folder
     worker_temp_dir = get_unique_foldername(base_folder, f"temp_{folder_name}")
     os.makedirs(worker_temp_dir, exist_ok=True)
 
-    band_paths = []
-    for band in bands:
-        resolution_folder = "R10m" if band in ["B02", "B03", "B04", "B08"] else "R20m"
-        pattern = os.path.join(
-            input_folder,
-            "GRANULE",
-            "*",
-            "IMG_DATA",
-            resolution_folder,
-            f"*_{band}_{resolution_folder[-3:]}.jp2",
-        )
-        print(f"Suche nach Dateien mit Muster: {pattern}")
-        paths = glob.glob(pattern)
-        if not paths:
-            print(f"Keine Dateien für Band {band} im Ordner {resolution_folder} gefunden.")
-            continue
-        band_paths.append(paths[0])
-
-    if not band_paths:
-        print(f"Keine Bänder zum Resamplen gefunden in {input_folder}.")
-        return
-
     temp_files = []
     try:
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
@@ -161,29 +574,19 @@ def resample_and_save_bands(
                 temp_path = os.path.join(worker_temp_dir, temp_filename)
                 temp_files.append(temp_path)
 
-                with rasterio.open(band_path) as src:
-                    bbox = src.bounds
-                    transform, width, height = rasterio.warp.calculate_default_transform(
-                        src.crs,
-                        src.crs,
-                        src.width,
-                        src.height,
-                        left=bbox.left,
-                        bottom=bbox.bottom,
-                        right=bbox.right,
-                        top=bbox.top,
-                        resolution=resolution,
-                    )
-
                 futures.append(
                     executor.submit(
                         resample_and_save_band,
                         band_path,
                         temp_path,
-                        transform,
-                        width,
-                        height,
-                        resolution,
+                        grid,
+                        block_size,
+                        worker_memory_mb,
+                        resampling,
+                        use_overviews,
+                        jp2_threads,
+                        aoi_geometries,
+                        scl_mask,
                     )
                 )
 
@@ -191,30 +594,570 @@ def resample_and_save_bands(
                 future.result()
 
         # Stack the temp files and save the multiband TIFF
-        temp_stack_path = os.path.join(worker_temp_dir, f"temp_stack_{folder_name}.tif")
-        stack_array, stack_meta = es.stack(temp_files, out_path=temp_stack_path)
-        stack_meta.update({"count": len(temp_files), "driver": "GTiff"})
+        with span("stack", scene=folder_name):
+            temp_stack_path = os.path.join(worker_temp_dir, f"temp_stack_{folder_name}.tif")
+            stack_array, stack_meta = es.stack(temp_files, out_path=temp_stack_path)
+            stack_meta.update({"count": len(temp_files), "driver": "GTiff"})
+            stack_meta.update(gtiff_options(output_profile, stack_meta["dtype"], block_size))
+            declare_nodata(stack_meta, aoi_geometries, scl_mask)
 
-        output_path = get_unique_filename(
-            temp_output_folder if temp_output_folder else final_output_folder,
-            base_filename,
-        )
+            with rasterio.open(output_path, "w", **stack_meta) as dst:
+                for idx in range(stack_array.shape[0]):
+                    dst.write(stack_array[idx], idx + 1)
+    finally:
+        # Clean up temporary files and directory
+        shutil.rmtree(worker_temp_dir, ignore_errors=True)
 
-        with rasterio.open(output_path, "w", **stack_meta) as dst:
-            for idx in range(stack_array.shape[0]):
-                dst.write(stack_array[idx], idx + 1)
 
-        print(f"Multiband-TIFF gespeichert als {output_path}")
+# Pre-create the multiband output and let every worker reproject its band straight into it
+def write_bands_direct(
+    band_paths,
+    grid,
+    output_path,
+    max_workers,
+    block_size,
+    worker_memory_mb,
+    resampling,
+    use_overviews,
+    jp2_threads,
+    output_profile,
+    aoi_geometries=None,
+    scl_mask=None,
+):
+    with rasterio.open(band_paths[0]) as src:
+        meta = src.meta.copy()
+    meta.update(grid)
+    meta.update(
+        {
+            "count": len(band_paths),
+            "driver": "GTiff",
+            # Band interleaving keeps the blocks of different bands apart for concurrent writers
+            "interleave": "band",
+        }
+    )
+    meta.update(tiled_profile(block_size))
+    meta.update(gtiff_options(output_profile, meta["dtype"], block_size))
+    declare_nodata(meta, aoi_geometries, scl_mask)
 
-        # Check if the number of files in the temp_output_folder exceeds the threshold
-        if temp_output_folder and len(os.listdir(temp_output_folder)) >= max_temp_files:
-            move_files(temp_output_folder, final_output_folder)
+    windows = plan_block_windows(grid["width"], grid["height"], block_size)
+    write_lock = Lock()
+    with rasterio.open(output_path, "w", **meta) as dst:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    resample_band_direct,
+                    band_path,
+                    dst,
+                    idx + 1,
+                    windows,
+                    write_lock,
+                    grid["transform"].a,
+                    worker_memory_mb,
+                    resampling,
+                    use_overviews,
+                    jp2_threads,
+                    aoi_geometries,
+                    scl_mask,
+                )
+                for idx, band_path in enumerate(band_paths)
+            ]
+            for future in as_completed(futures):
+                future.result()
 
-    finally:
-        # Clean up temporary files and directory
-        shutil.rmtree(worker_temp_dir, ignore_errors=True)
-        # Explicitly call garbage collector
-        gc.collect()
+
+def track_peak_memory(stop_event, stats, interval=0.1):
+    process = psutil.Process(os.getpid())
+    while not stop_event.is_set():
+        stats["peak_rss"] = max(stats["peak_rss"], process.memory_info().rss)
+        stop_event.wait(interval)
+
+
+def get_written_bytes():
+    process = psutil.Process(os.getpid())
+    # io_counters is not available on every platform (e.g. macOS)
+    if hasattr(process, "io_counters"):
+        return process.io_counters().write_bytes
+    return 0
+
+
+# Snap a coordinate to the grid defined by origin and step, rounding down or up
+def snap_to_grid(value, origin, step, round_fn):
+    # The tolerance keeps coordinates that already lie on the grid from being pushed a full step
+    offset = (value - origin) / step
+    return origin + round_fn(offset + (1e-9 if round_fn is math.floor else -1e-9)) * step
+
+
+# The AOI geometries in the coordinate system of a scene
+def scene_aoi_geometries(aoi, crs):
+    return [transform_geom(aoi["crs"], crs, geometry) for geometry in aoi["geometries"]]
+
+
+# Read the SCL layer of a scene once, clipped to the target grid. Returns the usable pixels on the SCL grid and
+# their fraction among the SCL pixels inside the grid and, with an AOI, inside its polygons
+def read_scl_mask(scl_path, grid, mask_classes, aoi_geometries=None):
+    left, top = grid["transform"] * (0, 0)
+    right, bottom = grid["transform"] * (grid["width"], grid["height"])
+    with rasterio.open(scl_path) as src:
+        col_start, row_start = ~src.transform * (left, top)
+        col_stop, row_stop = ~src.transform * (right, bottom)
+        col_off = max(0, math.floor(col_start + 1e-9))
+        row_off = max(0, math.floor(row_start + 1e-9))
+        col_end = min(src.width, math.ceil(col_stop - 1e-9))
+        row_end = min(src.height, math.ceil(row_stop - 1e-9))
+        window = Window(col_off, row_off, max(0, col_end - col_off), max(0, row_end - row_off))
+        scl = src.read(1, window=window)
+        transform = src.window_transform(window)
+
+    valid = ~np.isin(scl, mask_classes)
+    counted = np.ones(valid.shape, dtype=bool)
+    if aoi_geometries and valid.size:
+        counted = ~geometry_mask(aoi_geometries, out_shape=valid.shape, transform=transform)
+    total = int(counted.sum())
+    valid_fraction = float((valid & counted).sum()) / total if total else 0.0
+    return {"valid": valid, "transform": transform}, valid_fraction
+
+
+# Pixels of an output block whose SCL class is masked, looked up at the pixel centres (nearest neighbour);
+# pixels beyond the SCL layer are masked as well
+def scl_block_mask(scl_mask, window, dst_transform):
+    block_transform = window_transform(window, dst_transform)
+    scl_transform = scl_mask["transform"]
+    valid = scl_mask["valid"]
+    xs = block_transform.c + (np.arange(window.width) + 0.5) * block_transform.a
+    ys = block_transform.f + (np.arange(window.height) + 0.5) * block_transform.e
+    cols = np.floor((xs - scl_transform.c) / scl_transform.a).astype(np.int64)
+    rows = np.floor((ys - scl_transform.f) / scl_transform.e).astype(np.int64)
+    inside_cols = (cols >= 0) & (cols < valid.shape[1])
+    inside_rows = (rows >= 0) & (rows < valid.shape[0])
+    if not inside_cols.any() or not inside_rows.any():
+        return np.ones((window.height, window.width), dtype=bool)
+    masked = ~valid.take(np.clip(rows, 0, valid.shape[0] - 1), axis=0).take(
+        np.clip(cols, 0, valid.shape[1] - 1), axis=1
+    )
+    masked[~inside_rows, :] = True
+    masked[:, ~inside_cols] = True
+    return masked
+
+
+# Derive one target grid from a reference band that all bands of the scene are resampled into; with an AOI the
+# grid only covers the part of the scene inside the AOI bounds, or is None when the scene does not intersect it
+def plan_scene_grid(reference_band_path, resolution, grid_origin=None, grid_tile_size=None, aoi=None):
+    with rasterio.open(reference_band_path) as src:
+        crs = src.crs
+        left, bottom, right, top = src.bounds
+
+    if aoi is not None:
+        clipped = intersect_bounds((left, bottom, right, top), geometry_bounds(scene_aoi_geometries(aoi, crs)))
+        if clipped is None:
+            return None
+        if grid_origin is None and grid_tile_size is None:
+            # Stay on the pixel grid the whole scene would have been resampled into
+            clipped = (
+                snap_to_grid(clipped[0], left, resolution, math.floor),
+                snap_to_grid(clipped[1], top, resolution, math.floor),
+                snap_to_grid(clipped[2], left, resolution, math.ceil),
+                snap_to_grid(clipped[3], top, resolution, math.ceil),
+            )
+        left, bottom, right, top = clipped
+
+    if grid_origin is not None or grid_tile_size is not None:
+        origin_x, origin_y = grid_origin if grid_origin is not None else (0.0, 0.0)
+        step = grid_tile_size if grid_tile_size else resolution
+        if not math.isclose(step / resolution, round(step / resolution)):
+            raise ValueError(f"Grid tile size {step} is not a multiple of the resolution {resolution}.")
+        left = snap_to_grid(left, origin_x, step, math.floor)
+        right = snap_to_grid(right, origin_x, step, math.ceil)
+        bottom = snap_to_grid(bottom, origin_y, step, math.floor)
+        top = snap_to_grid(top, origin_y, step, math.ceil)
+
+    width = max(1, math.ceil((right - left) / resolution - 1e-9))
+    height = max(1, math.ceil((top - bottom) / resolution - 1e-9))
+    return {
+        "crs": crs,
+        "transform": rasterio.transform.from_origin(left, top, resolution, resolution),
+        "width": width,
+        "height": height,
+    }
+
+
+# Rough upper bound of the RAM a scene needs while it is processed in its own worker process
+def estimate_scene_memory(band_paths, grid, max_workers, direct_write, block_size, worker_memory_mb):
+    if not band_paths:
+        return PROCESS_OVERHEAD
+    width, height = grid["width"], grid["height"]
+    with rasterio.open(band_paths[0]) as src:
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+    band_bytes = width * height * itemsize
+    concurrent_bands = min(max_workers, len(band_paths))
+    if direct_write:
+        # Only one block per band plus the GDAL warp buffer is held at a time
+        if worker_memory_mb:
+            worker_bytes = worker_memory_mb * 1024 * 1024
+        else:
+            # Assume the finest (10 m) Sentinel-2 source band
+            scale = abs(grid["transform"].a) / 10
+            worker_bytes = block_footprint(block_size, scale, itemsize) + GDAL_WARP_MEMORY
+        return PROCESS_OVERHEAD + concurrent_bands * worker_bytes
+    # es.stack holds the whole stack while the resampled bands are still being written
+    return PROCESS_OVERHEAD + band_bytes * (len(band_paths) + concurrent_bands)
+
+
+def get_output_filename(input_folder):
+    folder_name = os.path.basename(input_folder)
+    date = folder_name[11:19]
+    # Use the date and the rest of the input folder name for the filename
+    return f"{date}_{folder_name}.tif"
+
+
+def get_scene_name(output_filename):
+    # Inverse of get_output_filename: strip the "YYYYMMDD_" prefix and the extension
+    return os.path.splitext(output_filename)[0][9:]
+
+
+# The settings that change the content or layout of an output; a scene is redone when one of them changes
+def get_scene_params(
+    bands, resolution, grid_origin, grid_tile_size, block_size, resampling, output_profile, aoi_path, scl_classes
+):
+    return encode_params(
+        {
+            "aoi": aoi_path,
+            "scl_classes": scl_classes,
+            "bands": bands,
+            "resolution": resolution,
+            "grid_origin": grid_origin,
+            "grid_tile_size": grid_tile_size,
+            "block_size": block_size,
+            "resampling": resampling,
+            "output_profile": output_profile,
+        }
+    )
+
+
+def resample_and_save_bands(
+    input_folder,
+    base_folder,
+    temp_output_folder,
+    final_output_folder,
+    bands,
+    resolution,
+    max_workers,
+    manifest_path=None,
+    direct_write=False,
+    grid_origin=None,
+    grid_tile_size=None,
+    block_size=512,
+    worker_memory_mb=None,
+    resampling="nearest",
+    use_overviews=False,
+    jp2_threads=None,
+    output_profile="none",
+    band_paths=None,
+    aoi=None,
+    scl_classes=None,
+    min_valid_fraction=0.0,
+    scl_path=None,
+    cube=None,
+):
+    folder_name = os.path.basename(input_folder)
+    base_filename = get_output_filename(input_folder)
+
+    # The band paths are normally taken from the catalogue of the whole base folder
+    if band_paths is None:
+        scene = scan_scene(input_folder)
+        band_paths = scene_band_paths(scene, bands, resolution)
+        if scl_classes is not None:
+            scl_path = next(iter(scene_band_paths(scene, ["SCL"], resolution)), None)
+
+    if not band_paths:
+        print(f"Keine Bänder zum Resamplen gefunden in {input_folder}.")
+        return
+
+    # The grid is planned once from the first band and shared by all band workers
+    grid = plan_scene_grid(band_paths[0], resolution, grid_origin, grid_tile_size, aoi)
+    if grid is None:
+        print(f"{folder_name} liegt außerhalb des AOI. Überspringe...")
+        return None
+    aoi_geometries = scene_aoi_geometries(aoi, grid["crs"]) if aoi is not None else None
+
+    # The SCL layer is read once and applied inside the windowed pass of every band; mostly cloudy scenes are
+    # skipped here, before any band is decoded
+    scl_mask = None
+    valid_fraction = None
+    if scl_classes is not None:
+        if scl_path is None:
+            print(f"Keine SCL-Datei in {input_folder} gefunden, die Szene wird ohne Wolkenmaske verarbeitet.")
+        else:
+            with span("scl", scene=folder_name):
+                scl_mask, valid_fraction = read_scl_mask(scl_path, grid, scl_classes, aoi_geometries)
+            print(f"{folder_name}: {valid_fraction:.1%} gültige Pixel laut SCL")
+            if valid_fraction < min_valid_fraction:
+                print(
+                    f"{folder_name} liegt unter dem Mindestanteil gültiger Pixel ({min_valid_fraction:.1%}). "
+                    "Überspringe..."
+                )
+                if manifest_path:
+                    update_scene(manifest_path, folder_name, "skipped", valid_fraction=valid_fraction)
+                return None
+
+    output_path = os.path.join(temp_output_folder if temp_output_folder else final_output_folder, base_filename)
+
+    stats = {"peak_rss": psutil.Process(os.getpid()).memory_info().rss}
+    written_before = get_written_bytes()
+    stop_event = Event()
+    memory_thread = Thread(target=track_peak_memory, args=(stop_event, stats), daemon=True)
+    memory_thread.start()
+    with span("scene", process_io=True, scene=folder_name) as scene_record:
+        try:
+            write_start = time.perf_counter()
+            # The output only appears under its final name once it is complete, so a crash never leaves a
+            # half-written file that looks finished; part files do not end in .tif, so they are never mosaicked
+            write_path = f"{output_path}.part"
+            if direct_write:
+                write_bands_direct(
+                    band_paths,
+                    grid,
+                    write_path,
+                    max_workers,
+                    block_size,
+                    worker_memory_mb,
+                    Resampling[resampling],
+                    use_overviews,
+                    jp2_threads,
+                    output_profile,
+                    aoi_geometries,
+                    scl_mask,
+                )
+            else:
+                write_bands_stacked(
+                    band_paths,
+                    grid,
+                    base_folder,
+                    folder_name,
+                    write_path,
+                    max_workers,
+                    block_size,
+                    worker_memory_mb,
+                    Resampling[resampling],
+                    use_overviews,
+                    jp2_threads,
+                    output_profile,
+                    aoi_geometries,
+                    scl_mask,
+                )
+            if output_driver(output_profile) == "COG":
+                cog_path = f"{output_path}.cog.part"
+                with span("cog", scene=folder_name):
+                    convert_to_cog(write_path, cog_path, output_profile, block_size)
+                write_path = cog_path
+            os.replace(write_path, output_path)
+            write_seconds = time.perf_counter() - write_start
+            scene_record["bytes"] = os.path.getsize(output_path)
+            if cube is not None:
+                # Appended by the worker itself, so scenes of different dates are written into the cube concurrently
+                with span("cube", scene=folder_name):
+                    write_to_cube(cube, output_path, base_filename[:8])
+            if manifest_path:
+                checksum = file_checksum(output_path)
+                update_scene(
+                    manifest_path,
+                    folder_name,
+                    "done",
+                    output_path=output_path,
+                    checksum=checksum,
+                    valid_fraction=valid_fraction,
+                )
+
+            print(f"Multiband-TIFF gespeichert als {output_path}")
+            report_output(output_path, output_profile, write_seconds, time_output_reads(output_path, block_size))
+        except BaseException:
+            # A failed scene leaves no partial output behind
+            for part_path in (f"{output_path}.part", f"{output_path}.cog.part"):
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            raise
+        finally:
+            stop_event.set()
+            memory_thread.join()
+            written_mb = (get_written_bytes() - written_before) / (1024 * 1024)
+            print(
+                f"Speicher-Peak: {stats['peak_rss'] / (1024 * 1024):.1f} MB, "
+                f"geschriebene Daten: {written_mb:.1f} MB "
+                f"({'direct write' if direct_write else 'es.stack'})"
+            )
+            # The decode, warp and write times of all bands of the scene
+            flush_totals("scene", scene=folder_name)
+            # Explicitly call garbage collector
+            gc.collect()
+
+    return output_path
+
+
+# Claim a scene for this node; a scene another node has finished with the same inputs and settings, as recorded
+# in the claim folder, is released again
+def claim_scene(claims, folder, fingerprint, scene_params, final_output_folder):
+    scene = os.path.basename(folder)
+    if claims is None:
+        return True
+    if not claim_work(claims, scene):
+        print(f"{scene} wird von einem anderen Knoten verarbeitet. Überspringe...")
+        return False
+    if is_scene_done(work_record(claims, scene), fingerprint, scene_params, final_output_folder):
+        release_work(claims, scene)
+        print(f"{scene} wurde bereits von einem anderen Knoten verarbeitet. Überspringe...")
+        return False
+    return True
+
+
+# Release the claim of a scene once its output is finished, i.e. after the transfer to the final folder; the
+# record of a finished scene is copied from the node's manifest into the claim folder for the other nodes
+def finish_scene(manifest_path, claims, scene, final_path=None):
+    if final_path:
+        record_moved_output(manifest_path, scene, final_path)
+    if claims is None:
+        return
+    record = load_scene_record(manifest_path, scene)
+    if record is not None and record["state"] == "done":
+        finish_work(claims, scene, record)
+    else:
+        release_work(claims, scene)
+
+
+# Queue the next scenes for staging into the local cache, keeping a bounded lookahead
+def prefetch_ahead(prefetch, folders, scenes):
+    if prefetch is None:
+        return
+    for folder in folders:
+        prefetch_scene(prefetch, folder, scene_input_paths(scenes[folder]))
+
+
+def scene_input_paths(scene):
+    return scene["band_paths"] + ([scene["scl_path"]] if scene["scl_path"] else [])
+
+
+# The band and SCL paths a scene is processed from: the cached copies when prefetching, else the originals
+def scene_inputs(prefetch, folder, scene):
+    paths = scene_input_paths(scene)
+    if prefetch is not None:
+        paths = staged_paths(prefetch, folder, paths)
+    band_count = len(scene["band_paths"])
+    return paths[:band_count], (paths[band_count] if scene["scl_path"] else None)
+
+
+# Run several scenes concurrently, admitting the next one only while its estimated footprint fits the RAM budget
+def process_folders_in_pool(
+    subfolders,
+    scene_kwargs,
+    scenes,
+    scene_params,
+    transfer_state,
+    max_temp_bytes,
+    scene_workers,
+    memory_budget_mb,
+    claims=None,
+    prefetch=None,
+    prefetch_scenes=0,
+):
+    if memory_budget_mb is None:
+        memory_budget = int(psutil.virtual_memory().available * 0.8)
+    else:
+        memory_budget = memory_budget_mb * 1024 * 1024
+    print(f"Szenen-Pool mit {scene_workers} Prozessen, RAM-Budget: {memory_budget / (1024 * 1024):.0f} MB")
+
+    total_folders = len(subfolders)
+    pending = deque(enumerate(subfolders))
+    estimates = {}
+    running = {}
+    reserved = 0
+
+    with ProcessPoolExecutor(max_workers=scene_workers) as executor:
+        while pending or running:
+            while pending and len(running) < scene_workers:
+                # The next scenes are staged while the running ones are processed
+                prefetch_ahead(prefetch, [folder for _, folder in list(pending)[: prefetch_scenes + 1]], scenes)
+                idx, folder = pending[0]
+                if folder not in estimates:
+                    estimates[folder] = estimate_folder_memory(scenes[folder]["band_paths"], scene_kwargs)
+                estimate = estimates[folder]
+                # A scene larger than the whole budget is still admitted once nothing else is running
+                if running and (
+                    reserved + estimate > memory_budget or estimate > psutil.virtual_memory().available
+                ):
+                    break
+                if transfer_state:
+                    wait_for_transfer_budget(transfer_state, max_temp_bytes)
+
+                pending.popleft()
+                scene = os.path.basename(folder)
+                fingerprint = scenes[folder]["fingerprint"]
+                if not claim_scene(claims, folder, fingerprint, scene_params, scene_kwargs["final_output_folder"]):
+                    if prefetch is not None:
+                        evict_scene(prefetch, folder)
+                    continue
+                print(
+                    f"Verarbeite Ordner {idx + 1} von {total_folders}: {folder} "
+                    f"(geschätzt {estimate / (1024 * 1024):.0f} MB)"
+                )
+                update_scene(scene_kwargs["manifest_path"], scene, "running", fingerprint, scene_params)
+                band_paths, scl_path = scene_inputs(prefetch, folder, scenes[folder])
+                future = executor.submit(
+                    resample_and_save_bands, folder, band_paths=band_paths, scl_path=scl_path, **scene_kwargs
+                )
+                running[future] = (folder, estimate)
+                reserved += estimate
+
+            gauge("scenes_running", len(running))
+            gauge("scenes_pending", len(pending))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, estimate = running.pop(future)
+                reserved -= estimate
+                scene = os.path.basename(folder)
+                manifest_path = scene_kwargs["manifest_path"]
+                if prefetch is not None:
+                    # The output is written, the cached inputs are no longer needed
+                    evict_scene(prefetch, folder)
+                try:
+                    output_path = future.result()
+                    print(f"Erfolgreich verarbeitet: {folder}")
+                except Exception as e:
+                    print(f"Fehler bei der Verarbeitung von {folder}: {e}")
+                    update_scene(manifest_path, scene, "failed")
+                    finish_scene(manifest_path, claims, scene)
+                    continue
+                if not output_path:
+                    # No bands, outside the AOI or too cloudy; the scene is checked again on the next run
+                    update_scene(manifest_path, scene, "skipped")
+                    finish_scene(manifest_path, claims, scene)
+                elif transfer_state:
+                    enqueue_transfer(transfer_state, output_path, partial(finish_scene, manifest_path, claims, scene))
+                else:
+                    finish_scene(manifest_path, claims, scene)
+
+
+def estimate_folder_memory(band_paths, scene_kwargs):
+    try:
+        if not band_paths:
+            return PROCESS_OVERHEAD
+        grid = plan_scene_grid(
+            band_paths[0],
+            scene_kwargs["resolution"],
+            scene_kwargs["grid_origin"],
+            scene_kwargs["grid_tile_size"],
+            scene_kwargs["aoi"],
+        )
+        if grid is None:
+            return PROCESS_OVERHEAD
+        return estimate_scene_memory(
+            band_paths,
+            grid,
+            scene_kwargs["max_workers"],
+            scene_kwargs["direct_write"],
+            scene_kwargs["block_size"],
+            scene_kwargs["worker_memory_mb"],
+        )
+    except Exception:
+        # Let the worker run into the error and report it like any other failure
+        return PROCESS_OVERHEAD
 
 
 def process_all_folders(
@@ -224,14 +1167,72 @@ def process_all_folders(
     bands,
     resolution,
     max_workers,
-    max_temp_files,
+    max_temp_mb,
+    direct_write=False,
+    scene_workers=1,
+    memory_budget_mb=None,
+    grid_origin=None,
+    grid_tile_size=None,
+    block_size=512,
+    worker_memory_mb=None,
+    resampling="nearest",
+    use_overviews=False,
+    jp2_threads=None,
+    gdal_cache_mb=None,
+    output_profile="none",
+    verify_transfer="size",
+    manifest_path=None,
+    aoi_path=None,
+    scl_classes=None,
+    min_valid_fraction=0.0,
+    claim_folder=None,
+    lease_seconds=300,
+    cache_folder=None,
+    prefetch_scenes=2,
+    cube=None,
 ):
     start_time = time.time()  # Start time measurement
 
-    processed_files = list_processed_files(final_output_folder)
-    delete_processed_folders(base_folder, processed_files)  # Delete already processed folders
+    if gdal_cache_mb:
+        # GDAL reads the cache size once per process on first use, so it is passed through the
+        # environment, which the scene worker processes inherit
+        os.environ["GDAL_CACHEMAX"] = str(gdal_cache_mb)
+
+    # The manifest replaces listing the final folder: every scene is looked up by name and redone when its
+    # inputs or the output settings changed or its last run did not finish
+    if manifest_path is None:
+        if claim_folder:
+            # Every node writes its own manifest; the finished scenes are shared through the claim folder
+            raise ValueError("--claim_folder requires a node-local --manifest; SQLite is not shared between nodes.")
+        manifest_path = os.path.join(final_output_folder, MANIFEST_NAME)
+    init_manifest(manifest_path, final_output_folder, get_scene_name)
+    manifest = load_manifest(manifest_path)
+    scene_params = get_scene_params(
+        bands, resolution, grid_origin, grid_tile_size, block_size, resampling, output_profile, aoi_path, scl_classes
+    )
 
     subfolders = [f.path for f in os.scandir(base_folder) if f.is_dir()]
+    # One directory walk per scene indexes all bands; the walks run concurrently before any scene is processed
+    catalog_start = time.time()
+    with span("catalog", process_io=True, folders=len(subfolders)):
+        catalog = build_catalog(subfolders)
+    print(f"Band-Katalog für {len(subfolders)} Ordner in {time.time() - catalog_start:.2f} Sekunden erstellt.")
+    # Delete already processed folders
+    fingerprints = delete_processed_folders(subfolders, catalog, manifest, scene_params, final_output_folder)
+    subfolders = list(fingerprints)
+    scenes = {
+        folder: {
+            "fingerprint": fingerprints[folder],
+            "band_paths": scene_band_paths(catalog[folder], bands, resolution),
+            # The SCL layer is only looked up when masking is enabled
+            "scl_path": (
+                next(iter(scene_band_paths(catalog[folder], ["SCL"], resolution)), None)
+                if scl_classes is not None
+                else None
+            ),
+        }
+        for folder in subfolders
+    }
 
     # Extract numeric part from folder names and sort numerically
     def extract_numeric_part(folder_name):
@@ -242,26 +1243,102 @@ def process_all_folders(
     total_folders = len(subfolders)
     print(f"Es wurden {total_folders} Unterordner gefunden.")
 
-    for idx, folder in enumerate(subfolders):
-        print(f"Verarbeite Ordner {idx + 1} von {total_folders}: {folder}")
-        try:
-            resample_and_save_bands(
-                folder,
-                base_folder,
-                temp_output_folder,
-                final_output_folder,
-                bands,
-                resolution,
-                max_workers,
-                max_temp_files,
-                processed_files,
+    # Arguments passed to resample_and_save_bands for every scene, in either mode
+    scene_kwargs = {
+        "base_folder": base_folder,
+        "temp_output_folder": temp_output_folder,
+        "final_output_folder": final_output_folder,
+        "bands": bands,
+        "resolution": resolution,
+        "max_workers": max_workers,
+        "manifest_path": manifest_path,
+        "direct_write": direct_write,
+        "grid_origin": grid_origin,
+        "grid_tile_size": grid_tile_size,
+        "block_size": block_size,
+        "worker_memory_mb": worker_memory_mb,
+        "resampling": resampling,
+        "use_overviews": use_overviews,
+        "jp2_threads": jp2_threads,
+        "output_profile": output_profile,
+        # Loaded once here; every scene only transforms it into its own CRS
+        "aoi": load_aoi(aoi_path) if aoi_path else None,
+        "scl_classes": scl_classes,
+        "min_valid_fraction": min_valid_fraction,
+        "cube": cube,
+    }
+
+    # Finished outputs are moved from the temp folder to the final folder in the background, overlapping with
+    # the processing of the next scenes; processing only waits once max_temp_mb of outputs are still pending
+    transfer_state = None
+    max_temp_bytes = max_temp_mb * 1024 * 1024
+    if temp_output_folder:
+        transfer_state = start_transfer_worker(final_output_folder, verify_transfer)
+    # Several nodes sharing the base folder claim every scene before processing it; the leases are renewed
+    # until the output has reached the final folder
+    claims = start_claims(claim_folder, lease_seconds, CLAIM_MESSAGES) if claim_folder else None
+    # The band files of the next prefetch_scenes scenes are copied into the local cache in the background
+    prefetch = start_prefetch(cache_folder) if cache_folder else None
+
+    try:
+        if scene_workers > 1:
+            process_folders_in_pool(
+                subfolders,
+                scene_kwargs,
+                scenes,
+                scene_params,
+                transfer_state,
+                max_temp_bytes,
+                scene_workers,
+                memory_budget_mb,
+                claims,
+                prefetch,
+                prefetch_scenes,
             )
-            print(f"Erfolgreich verarbeitet: {folder}")
-        except Exception as e:
-            print(f"Fehler bei der Verarbeitung von {folder}: {e}")
-        finally:
-            # Explicitly call garbage collector after processing each folder
-            gc.collect()
+        else:
+            for idx, folder in enumerate(subfolders):
+                prefetch_ahead(prefetch, subfolders[idx : idx + prefetch_scenes + 1], scenes)
+                if transfer_state:
+                    wait_for_transfer_budget(transfer_state, max_temp_bytes)
+                scene = os.path.basename(folder)
+                if not claim_scene(claims, folder, scenes[folder]["fingerprint"], scene_params, final_output_folder):
+                    if prefetch is not None:
+                        evict_scene(prefetch, folder)
+                    continue
+                print(f"Verarbeite Ordner {idx + 1} von {total_folders}: {folder}")
+                update_scene(manifest_path, scene, "running", scenes[folder]["fingerprint"], scene_params)
+                try:
+                    band_paths, scl_path = scene_inputs(prefetch, folder, scenes[folder])
+                    output_path = resample_and_save_bands(
+                        folder, band_paths=band_paths, scl_path=scl_path, **scene_kwargs
+                    )
+                    print(f"Erfolgreich verarbeitet: {folder}")
+                    if not output_path:
+                        # No bands, outside the AOI or too cloudy; the scene is checked again on the next run
+                        update_scene(manifest_path, scene, "skipped")
+                        finish_scene(manifest_path, claims, scene)
+                    elif transfer_state:
+                        on_moved = partial(finish_scene, manifest_path, claims, scene)
+                        enqueue_transfer(transfer_state, output_path, on_moved)
+                    else:
+                        finish_scene(manifest_path, claims, scene)
+                except Exception as e:
+                    print(f"Fehler bei der Verarbeitung von {folder}: {e}")
+                    update_scene(manifest_path, scene, "failed")
+                    finish_scene(manifest_path, claims, scene)
+                finally:
+                    if prefetch is not None:
+                        evict_scene(prefetch, folder)
+                    # Explicitly call garbage collector after processing each folder
+                    gc.collect()
+    finally:
+        # Drain the transfer queue, also when processing was interrupted
+        if transfer_state:
+            stop_transfer_worker(transfer_state)
+        if claims is not None:
+            stop_claims(claims)
+        if prefetch is not None:
+            stop_prefetch(prefetch)
 
     # Ensure any remaining files are moved
     if temp_output_folder and len(os.listdir(temp_output_folder)) > 0:
@@ -272,16 +1349,6 @@ def process_all_folders(
     print(f"Alle Ordner wurden verarbeitet. Gesamtdauer: {elapsed_time:.2f} Sekunden.")
 
 
-def monitor_resources(stop_event, interval=1):
-    while not stop_event.is_set():
-        cpu_usages = psutil.cpu_percent(interval=interval, percpu=True)
-        memory_info = psutil.Process(os.getpid()).memory_info()
-        for i, cpu_usage in enumerate(cpu_usages):
-            print(f"CPU Core {i} Usage: {cpu_usage}%")
-        print(f"Memory Usage: {memory_info.rss / (1024 * 1024)} MB")
-        time.sleep(interval)
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Resample and save Sentinel-2 bands.")
     parser.add_argument(
@@ -321,14 +1388,214 @@ if __name__ == "__main__":
         help="Number of workers for parallel processing (default: 10).",
     )
     parser.add_argument(
-        "--max_temp_files",
+        "--max_temp_mb",
         type=int,
-        default=10,
-        help="Maximum number of files in the temporary folder before moving (default: 10).",
+        default=20480,
+        help="Maximum size of outputs in the temporary folder that are not yet moved, in MB; processing waits "
+        "for the background transfer when it is exceeded (default: 20480).",
+    )
+    parser.add_argument(
+        "--verify_transfer",
+        type=str,
+        default="size",
+        choices=["size", "checksum"],
+        help="How outputs are verified after copying them to the final folder (default: size).",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help=f"SQLite manifest of the processed scenes used to resume interrupted runs "
+        f"(default: {MANIFEST_NAME} in the final output folder; required on a local disk with --claim_folder).",
+    )
+    parser.add_argument(
+        "--aoi",
+        type=str,
+        help="GeoJSON or other vector file with the area of interest; only the part of every scene inside it is "
+        "resampled, pixels outside the polygons are set to nodata and scenes outside it are skipped.",
+    )
+    parser.add_argument(
+        "--claim_folder",
+        type=str,
+        help="Shared folder for lease files; every scene is claimed before it is processed, so the same command "
+        "can run on several nodes mounting the same storage.",
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        type=int,
+        default=300,
+        help="Claims not renewed within this time are taken over from dead nodes (default: 300).",
+    )
+    parser.add_argument(
+        "--cache_folder",
+        type=str,
+        help="Local SSD folder the band files of the next scenes are staged into in the background while the "
+        "current scene is processed; every scene is removed from it once its output is written.",
+    )
+    parser.add_argument(
+        "--prefetch_scenes",
+        type=int,
+        default=2,
+        help="Number of upcoming scenes staged ahead into --cache_folder (default: 2).",
+    )
+    parser.add_argument(
+        "--cube",
+        type=str,
+        help="Zarr data cube (time, band, y, x) every output is additionally written into; requires zarr.",
+    )
+    parser.add_argument(
+        "--cube_bounds",
+        type=float,
+        nargs=4,
+        metavar=("MINX", "MINY", "MAXX", "MAXY"),
+        help="Extent of the data cube in the CRS of the outputs; the outputs have to be aligned with its grid, "
+        "e.g. with --grid_origin MINX MAXY.",
+    )
+    parser.add_argument(
+        "--cube_chunk_size",
+        type=int,
+        default=256,
+        help="Edge length of the spatial chunks of the data cube in pixels (default: 256).",
+    )
+    parser.add_argument(
+        "--cube_time_chunk",
+        type=int,
+        default=1,
+        help="Number of dates per chunk of the data cube; larger values speed up time series reads, while "
+        "writers of dates in the same chunk wait for each other (default: 1).",
+    )
+    parser.add_argument(
+        "--cube_compression",
+        type=str,
+        default="zstd",
+        choices=CUBE_COMPRESSIONS,
+        help="Compression of the data cube chunks (default: zstd).",
+    )
+    parser.add_argument(
+        "--scl_mask",
+        action="store_true",
+        help="Mask clouds and invalid pixels with the Scene Classification layer (SCL) of the L2A products; masked "
+        "pixels are set to nodata within the resampling pass.",
+    )
+    parser.add_argument(
+        "--scl_classes",
+        type=int,
+        nargs="+",
+        default=SCL_MASK_CLASSES,
+        help="SCL classes masked by --scl_mask (default: 0 1 3 8 9 10, no data, saturated, cloud shadows, "
+        "clouds and cirrus).",
+    )
+    parser.add_argument(
+        "--min_valid_fraction",
+        type=float,
+        default=0.0,
+        help="Skip scenes whose fraction of unmasked pixels is below this value (0-1, requires --scl_mask; "
+        "default: 0).",
+    )
+    parser.add_argument(
+        "--direct_write",
+        action="store_true",
+        help="Write resampled bands directly into the multiband output instead of temp files and es.stack.",
+    )
+    parser.add_argument(
+        "--scene_workers",
+        type=int,
+        default=1,
+        help="Number of scenes processed concurrently in separate processes (default: 1).",
+    )
+    parser.add_argument(
+        "--memory_budget_mb",
+        type=int,
+        help="RAM budget for concurrently processed scenes in MB (default: 80%% of the available memory).",
+    )
+    parser.add_argument(
+        "--grid_origin",
+        type=float,
+        nargs=2,
+        metavar=("X", "Y"),
+        help="Snap the output grid to this origin so that outputs of different dates align pixel by pixel.",
+    )
+    parser.add_argument(
+        "--grid_tile_size",
+        type=float,
+        help="Snap the output extent to tiles of this size in CRS units (multiple of the resolution).",
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=512,
+        help="Edge length of the processing blocks and GeoTIFF tiles in pixels, multiple of 16 (default: 512).",
+    )
+    parser.add_argument(
+        "--worker_memory_mb",
+        type=int,
+        help="Hard memory cap per band worker in MB; blocks are split until they fit.",
+    )
+    parser.add_argument(
+        "--resampling",
+        type=str,
+        default="nearest",
+        choices=["nearest", "bilinear", "cubic", "cubic_spline", "lanczos", "average", "mode", "min", "max", "med"],
+        help="Resampling method (default: nearest). Integer-factor nearest, average, mode, min, max and med "
+        "resampling use a NumPy fast path.",
+    )
+    parser.add_argument(
+        "--use_overviews",
+        action="store_true",
+        help="Decode JPEG2000 bands at a reduced resolution level when downsampling. The levels are the "
+        "decoder's wavelet approximations, so values differ slightly from resampling the full resolution.",
+    )
+    parser.add_argument(
+        "--jp2_threads",
+        type=int,
+        help="JPEG2000 decoder threads per band worker (GDAL_NUM_THREADS).",
+    )
+    parser.add_argument(
+        "--gdal_cache_mb",
+        type=int,
+        help="GDAL block cache size per process in MB (GDAL_CACHEMAX).",
+    )
+    parser.add_argument(
+        "--output_profile",
+        type=str,
+        default="none",
+        choices=list(OUTPUT_PROFILES),
+        help="Output profile: compression, tiling and COG layout of the multiband TIFF (default: none).",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="JSON lines file for timed spans per scene, band and stage, accumulated decode, warp and write times, "
+        "queue depths and resource samples of all processes; a summary is printed at the end.",
+    )
+    parser.add_argument(
+        "--prometheus",
+        type=str,
+        help="Prometheus textfile the summary of the run is written to (e.g. for the node exporter).",
+    )
+    parser.add_argument(
+        "--monitor",
+        action="store_true",
+        help="Sample CPU and memory usage every second, into --metrics if given.",
     )
-    parser.add_argument("--monitor", action="store_true", help="Enable CPU and memory monitoring.")
     args = parser.parse_args()
+    if args.min_valid_fraction > 0 and not args.scl_mask:
+        parser.error("--min_valid_fraction requires --scl_mask")
+    if args.cube and not args.cube_bounds:
+        parser.error("--cube requires --cube_bounds")
+    if args.claim_folder and not args.manifest:
+        parser.error("--claim_folder requires a node-local --manifest; SQLite is not shared between nodes")
+    cube = None
+    if args.cube:
+        cube = cube_settings(
+            args.cube,
+            args.cube_bounds,
+            args.cube_chunk_size,
+            args.cube_time_chunk,
+            args.cube_compression,
+            args.bands,
+        )
 
+    configure_metrics(args.metrics, args.prometheus)
     stop_event = Event()
 
     if args.monitor:
@@ -344,10 +1611,33 @@ if __name__ == "__main__":
         args.bands,
         args.resolution,
         args.max_workers,
-        args.max_temp_files,
+        args.max_temp_mb,
+        args.direct_write,
+        args.scene_workers,
+        args.memory_budget_mb,
+        args.grid_origin,
+        args.grid_tile_size,
+        args.block_size,
+        args.worker_memory_mb,
+        args.resampling,
+        args.use_overviews,
+        args.jp2_threads,
+        args.gdal_cache_mb,
+        args.output_profile,
+        args.verify_transfer,
+        args.manifest,
+        args.aoi,
+        args.scl_classes if args.scl_mask else None,
+        args.min_valid_fraction,
+        args.claim_folder,
+        args.lease_seconds,
+        args.cache_folder,
+        args.prefetch_scenes,
+        cube,
     )
     print("Verarbeitung abgeschlossen.")
 
     if args.monitor:
         stop_event.set()
         monitor_thread.join()
+    report_metrics("resampling", args.prometheus)
@@ -0,0 +1,63 @@
+# indexing the band files of Sentinel-2 L2A SAFE folders with a single directory walk per scene
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# e.g. T33UUU_20230601T101031_B8A_20m.jp2 -> band B8A at 20 m
+BAND_FILE_PATTERN = re.compile(r"_([A-Z0-9]{3})_(\d+)m\.jp2$")
+
+
+def scandir_dirs(folder):
+    try:
+        return [entry for entry in os.scandir(folder) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+# Every band at every native resolution of a scene, plus (relative path, size, mtime) of the band files
+def scan_scene(input_folder):
+    bands = {}
+    files = []
+    for granule in scandir_dirs(os.path.join(input_folder, "GRANULE")):
+        for resolution_folder in scandir_dirs(os.path.join(granule.path, "IMG_DATA")):
+            for entry in os.scandir(resolution_folder.path):
+                match = BAND_FILE_PATTERN.search(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                band, resolution = match.group(1), int(match.group(2))
+                bands.setdefault(band, {}).setdefault(resolution, entry.path)
+                stat = entry.stat()
+                files.append((os.path.relpath(entry.path, input_folder), stat.st_size, stat.st_mtime_ns))
+    return {"bands": bands, "files": files}
+
+
+# Scan all scenes of a base folder at once; the threads hide the latency of network file systems
+def build_catalog(subfolders, max_workers=16):
+    def scan(folder):
+        try:
+            return scan_scene(folder)
+        except OSError as e:
+            print(f"Ordner {folder} konnte nicht gelesen werden: {e}")
+            return {"bands": {}, "files": []}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(subfolders, executor.map(scan, subfolders)))
+
+
+# The coarsest native resolution that is still at least as fine as the target, so no detail is lost and as
+# little data as possible is decoded; bands only available coarser than the target use their finest resolution
+def select_source_resolution(resolutions, target_resolution):
+    finer = [resolution for resolution in resolutions if resolution <= target_resolution]
+    return max(finer) if finer else min(resolutions)
+
+
+def scene_band_paths(scene, bands, target_resolution):
+    band_paths = []
+    for band in bands:
+        resolutions = scene["bands"].get(band)
+        if not resolutions:
+            print(f"Keine Dateien für Band {band} gefunden.")
+            continue
+        band_paths.append(resolutions[select_source_resolution(resolutions, target_resolution)])
+    return band_paths
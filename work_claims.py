@@ -0,0 +1,188 @@
+# claiming scenes or dates through lease files in a shared folder, so the same command can run on several nodes
+# mounting the same storage without a central coordinator. The records of finished work live in the same folder as
+# atomically replaced files; SQLite manifests are not shared between nodes, its locking is unreliable on NFS
+
+import os
+import json
+import socket
+import uuid
+from threading import Thread, Event, Lock
+
+LEASE_SUFFIX = ".lease"
+DONE_SUFFIX = ".done"
+# Messages of the claims; every script passes them in the language of its own output to start_claims
+CLAIM_MESSAGES = {
+    "taken_over": "Took over the stale claim of {key} ({age:.0f} s without renewal)",
+    "lost": "The claim of {key} was taken over by another node",
+    "renew_failed": "Renewing the claim of {key} failed: {error}",
+}
+
+
+# Unique per process, readable in the lease files
+def claim_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def lease_path(claim_folder, key):
+    return os.path.join(claim_folder, f"{key}{LEASE_SUFFIX}")
+
+
+def read_owner(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+# The current time of the shared file system; comparing lease ages with the local clock would break with
+# clocks that differ between the nodes
+def shared_now(claim_folder, owner):
+    clock_path = os.path.join(claim_folder, f".clock_{owner.replace(':', '_')}")
+    with open(clock_path, "w"):
+        pass
+    try:
+        return os.stat(clock_path).st_mtime
+    finally:
+        os.remove(clock_path)
+
+
+def create_lease(path, owner):
+    try:
+        # O_EXCL makes the creation atomic, also on NFS v3 and later
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(owner)
+    return True
+
+
+def done_path(claim_folder, key):
+    return os.path.join(claim_folder, f"{key}{DONE_SUFFIX}")
+
+
+# Record what a finished key was made from (e.g. input fingerprints and settings); the record is replaced
+# atomically, so other nodes read either the previous or the new one
+def write_done(claim_folder, key, record):
+    path = done_path(claim_folder, key)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(record, f)
+    os.replace(temp_path, path)
+
+
+def read_done(claim_folder, key):
+    try:
+        with open(done_path(claim_folder, key)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# Claim a key for this process. A lease that was not renewed within lease_seconds belongs to a dead process and
+# is taken over. Whether the work of a claimed key is already done is up to the caller, see read_done
+def claim(claim_folder, key, owner, lease_seconds=300, messages=CLAIM_MESSAGES):
+    path = lease_path(claim_folder, key)
+    if create_lease(path, owner):
+        return True
+    try:
+        age = shared_now(claim_folder, owner) - os.stat(path).st_mtime
+    except FileNotFoundError:
+        # Released in the meantime
+        return create_lease(path, owner)
+    if age <= lease_seconds:
+        return False
+    # Only one of several nodes taking over the same stale lease wins the rename
+    stale_path = f"{path}.stale_{uuid.uuid4().hex}"
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return False
+    if shared_now(claim_folder, owner) - os.stat(stale_path).st_mtime <= lease_seconds:
+        # Another node took the lease over between the age check and the rename; hand it back
+        try:
+            os.link(stale_path, path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    print(messages["taken_over"].format(key=key, age=age))
+    return create_lease(path, owner)
+
+
+def release(claim_folder, key, owner):
+    path = lease_path(claim_folder, key)
+    if read_owner(path) == owner:
+        os.remove(path)
+
+
+def renew_leases(state, interval):
+    while not state["stop_event"].wait(interval):
+        with state["lock"]:
+            keys = list(state["keys"])
+        for key in keys:
+            path = lease_path(state["claim_folder"], key)
+            try:
+                if read_owner(path) != state["owner"]:
+                    print(state["messages"]["lost"].format(key=key))
+                    with state["lock"]:
+                        state["keys"].discard(key)
+                    continue
+                os.utime(path)
+            except OSError as e:
+                # A short outage of the shared storage; the lease survives as long as it is renewed in time
+                print(state["messages"]["renew_failed"].format(key=key, error=e))
+
+
+# Claims of one process, renewed by a background thread every third of the lease time while work is active
+def start_claims(claim_folder, lease_seconds=300, messages=CLAIM_MESSAGES):
+    os.makedirs(claim_folder, exist_ok=True)
+    state = {
+        "claim_folder": claim_folder,
+        "owner": claim_owner(),
+        "lease_seconds": lease_seconds,
+        "messages": messages,
+        "keys": set(),
+        "lock": Lock(),
+        "stop_event": Event(),
+    }
+    state["thread"] = Thread(target=renew_leases, args=(state, lease_seconds / 3), daemon=True)
+    state["thread"].start()
+    return state
+
+
+def claim_work(state, key):
+    if not claim(state["claim_folder"], key, state["owner"], state["lease_seconds"], state["messages"]):
+        return False
+    with state["lock"]:
+        state["keys"].add(key)
+    return True
+
+
+def release_work(state, key):
+    with state["lock"]:
+        state["keys"].discard(key)
+    release(state["claim_folder"], key, state["owner"])
+
+
+# Record the finished work of a key before giving up its claim, so no other node takes it up in between
+def finish_work(state, key, record):
+    write_done(state["claim_folder"], key, record)
+    release_work(state, key)
+
+
+def work_record(state, key):
+    return read_done(state["claim_folder"], key)
+
+
+# Stop renewing and give up every claim that is still held, e.g. after an interruption
+def stop_claims(state):
+    state["stop_event"].set()
+    state["thread"].join()
+    with state["lock"]:
+        keys = list(state["keys"])
+        state["keys"].clear()
+    for key in keys:
+        release(state["claim_folder"], key, state["owner"])